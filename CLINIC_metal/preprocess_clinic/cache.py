@@ -0,0 +1,76 @@
+# Content-addressed on-disk cache of preprocessed CLINIC volumes (Xma, XLI, M, Sma, SLI, Tr)
+import os
+import json
+import hashlib
+import h5py
+import numpy as np
+
+# bump whenever the preprocessing changes its output, older entries are then never hit
+CACHE_VERSION = 1
+BINARY_KEYS = ('M', 'Tr')  # stored as uint8
+
+
+def file_digest(path, block=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class PreprocessCache(object):
+    """One compressed h5 file per preprocessed volume, named by the hash of the input file and of the
+    preprocessing configuration. max_bytes bounds the cache, least recently used entries go first."""
+    def __init__(self, cache_dir, max_bytes=50 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, file_path, config):
+        config = json.dumps(dict(config, version=CACHE_VERSION), sort_keys=True, default=str)
+        return hashlib.sha1((file_digest(file_path) + config).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.h5')
+
+    def load(self, key, keys):
+        # (affine, [arrays in the order of keys]) or None on a miss
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with h5py.File(path, 'r') as f:
+                affine = f['affine'][()]
+                arrays = [f[k][()].astype(np.float32) if k in BINARY_KEYS else f[k][()] for k in keys]
+        except (OSError, KeyError):  # partially written or foreign file
+            os.remove(path)
+            return None
+        os.utime(path)  # access time of the LRU
+        return affine, arrays
+
+    def store(self, key, affine, keys, arrays):
+        path = self.path(key)
+        tmp = '{}.{:d}.tmp'.format(path, os.getpid())
+        with h5py.File(tmp, 'w') as f:
+            f.create_dataset('affine', data=affine)
+            for k, array in zip(keys, arrays):
+                array = np.asarray(array)
+                # one chunk per slice (slices last), lzf for speed
+                f.create_dataset(k, data=array.astype(np.uint8) if k in BINARY_KEYS else array,
+                                 chunks=array.shape[:2] + (1,), compression='lzf')
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.h5'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
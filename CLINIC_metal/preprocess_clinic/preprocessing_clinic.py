@@ -2,77 +2,242 @@
 import nibabel
 import numpy as np
 import os
-from scipy.interpolate import interp1d
+import time
+import shutil
+import tempfile
+import multiprocessing
+import argparse
+import hashlib
+from collections import Counter, OrderedDict
 from .utils import get_config
-from .build_gemotry import initialization, imaging_geo
+from network.build_gemotry import get_operators, geometry_key
+from network.interpolation import interpolate_projection
+from .build_gemotry import initialization
+from .cache import PreprocessCache
 import PIL
 from PIL import Image
 config = get_config('CLINIC_metal/preprocess_clinic/dataset_py_640geo.yaml')
 CTpara = config['CTpara']  # CT imaging parameters
 mask_thre = 2500 /1000 * 0.192 + 0.192  # taking 2500HU as a thresholding to segment the metal region
 param = initialization()
-ray_trafo, FBPOper = imaging_geo(param)  # CT imaging geometry, ray_trafo is fp, FBPoper is fbp
-allXma = []
-allXLI = []
-allM = []
-allSma = []
-allSLI = []
-allTr = []
-allaffine = []
-allfilename=[]
-# process and save all the to-the-tested volumes
-def clinic_input_data(test_path):
-    for file_name in os.listdir(test_path):
+VOLUME_KEYS = ('Xma', 'XLI', 'M', 'Sma', 'SLI', 'Tr')
+TRACE_CACHE_SIZE = 128  # metal traces kept per process, ~0.4 MB each
+trace_cache = OrderedDict()
+
+
+# process the to-be-tested volumes one at a time
+def clinic_volumes(test_path, workers=0, out_dir=None, impl='astra_cuda', chunk=4, cache_dir=None,
+                   cache_size=50 * 2 ** 30):
+    # yields (file_name, affine, Xma, XLI, M, Sma, SLI, Tr) per volume, every array with the slices last;
+    # only the volume being yielded is held in memory.
+    # workers > 0 spreads the slices over a process pool writing into memmaps under out_dir (a temporary
+    # folder by default, cleared volume by volume); the next volume is preprocessed while this one is consumed.
+    # cache_dir keeps the preprocessed volumes (at most cache_size bytes) keyed by the content of the
+    # input file and the preprocessing configuration, so later runs skip the preprocessing
+    file_names = sorted(os.listdir(test_path))
+    cache = PreprocessCache(cache_dir, cache_size) if cache_dir else None
+    if workers > 0:
+        yield from _pooled_volumes(test_path, file_names, workers, out_dir, impl, chunk, cache)
+        return
+    geometry = get_operators(param.param, impl=impl)  # CT imaging geometry, built on first use
+    for file_name in file_names:
         file_path = test_path+'/'+file_name
+        key, hit = cache_lookup(cache, file_path, file_name, impl)
+        if hit is not None:
+            yield (file_name,) + hit
+            continue
+        ray_trafo, FBPOper = geometry.ray_trafo, geometry.fbp  # ray_trafo is fp, FBPoper is fbp
         img = nibabel.load(file_path)
         imag = img.get_fdata()  # imag with pixel as HU unit
-        affine = img.affine
-        allaffine.append(affine)
+        start_time = time.time()
+        stats = Counter()
+        Xma, XLI, M, Sma, SLI, Tr = preprocess_volume(imag, ray_trafo, FBPOper, stats)
+        report(file_name, time.time() - start_time, stats)
+        if cache is not None:
+            cache.store(key, img.affine, VOLUME_KEYS, (Xma, XLI, M, Sma, SLI, Tr))
+        yield file_name, img.affine, Xma, XLI, M, Sma, SLI, Tr
+
+
+def cache_lookup(cache, file_path, file_name, impl):
+    # (key, (affine, Xma, XLI, M, Sma, SLI, Tr) or None)
+    if cache is None:
+        return None, None
+    config = dict(CTpara=CTpara, mask_thre=mask_thre, geometry=geometry_key(param.param), impl=impl)
+    key = cache.key(file_path, config)
+    hit = cache.load(key, VOLUME_KEYS)
+    if hit is None:
+        return key, None
+    print('preprocessed {}: from the cache'.format(file_name))
+    return key, (hit[0],) + tuple(hit[1])
+
+
+def report(file_name, seconds, stats):
+    print('preprocessed {}: {:.2f} slices/s, {:.1%} metal-free, {:d} metal traces from cache'.format(
+        file_name, stats['slices'] / seconds, stats['metal_free'] / max(stats['slices'], 1), stats['trace_hits']))
+
+
+def preprocess_volume(imag, ray_trafo, FBPOper, stats=None):
+    num_s = imag.shape[2]
+    M  = np.zeros((CTpara['imPixNum'], CTpara['imPixNum'], num_s), dtype='float32')
+    Xma = np.zeros_like(M)
+    XLI = np.zeros_like(M)
+    Tr = np.zeros((CTpara['sinogram_size_x'], CTpara['sinogram_size_y'], num_s), dtype='float32')
+    Sma = np.zeros_like(Tr)
+    SLI =  np.zeros_like(Tr)
+    volume = (Xma, XLI, M, Sma, SLI, Tr)
+    for i in range(num_s):
+        for array, data in zip(volume, preprocess_slice(imag[:,:,i], ray_trafo, FBPOper, stats)):
+            array[...,i] = data
+    return volume
+
+
+def preprocess_slice(image, ray_trafo, FBPOper, stats=None):
+    # one HU slice -> Xma, XLI, M, Sma, SLI, Tr
+    # metal-free slices skip the metal projection, LI and FBP (XLI = Xma, SLI = Sma, Tr = 0)
+    stats = Counter() if stats is None else stats
+    stats['slices'] += 1
+    image = np.array(Image.fromarray(image).resize((CTpara['imPixNum'], CTpara['imPixNum']), PIL.Image.BILINEAR))
+    image[image < -1000] = -1000
+    image = image / 1000 * 0.192 + 0.192
+    M = np.zeros(image.shape, dtype='float32')
+    [rowindex, colindex] = np.where(image > mask_thre)
+    M[rowindex, colindex] = 1
+    Sma = np.asarray(ray_trafo(image), dtype='float32')
+    if not len(rowindex):
+        stats['metal_free'] += 1
+        return image, image.astype('float32'), M, Sma, Sma, np.zeros_like(Sma)
+    Tr = metal_trace(M, ray_trafo, stats)
+    SLI = interpolate_projection(Sma, Tr)
+    XLI = np.asarray(FBPOper(SLI))
+    return image, XLI, M, Sma, SLI, Tr
+
+
+def volume_memmaps(out_dir, file_name, num_s=None, mode='r'):
+    # one (num_s, H, W) float32 .npy per array, returned as (H, W, num_s) views
+    arrays = []
+    for key in VOLUME_KEYS:
+        path = os.path.join(out_dir, '{}_{}.npy'.format(file_name, key))
+        if mode == 'w+':
+            shape = (CTpara['imPixNum'], CTpara['imPixNum']) if key[0] in 'XM' else \
+                    (CTpara['sinogram_size_x'], CTpara['sinogram_size_y'])
+            array = np.lib.format.open_memmap(path, mode, np.float32, (num_s,) + shape)
+        else:
+            array = np.load(path, mmap_mode=mode)
+        arrays.append(np.moveaxis(array, 0, -1))
+    return arrays
+
+
+_worker = {}
+
+
+def _init_worker(impl):
+    geometry = get_operators(param.param, impl=impl)
+    _worker['ops'] = geometry.ray_trafo, geometry.fbp
+
+
+def metal_trace(M, ray_trafo, stats):
+    # Tr of a binary metal mask, cached by the hash of the mask
+    key = hashlib.sha1(np.packbits(M.astype(bool)).tobytes()).hexdigest()
+    if key in trace_cache:
+        trace_cache.move_to_end(key)
+        stats['trace_hits'] += 1
+    else:
+        Pmetal_kev = np.asarray(ray_trafo(M))
+        trace_cache[key] = Pmetal_kev > 0
+        if len(trace_cache) > TRACE_CACHE_SIZE:
+            trace_cache.popitem(last=False)
+    return trace_cache[key].astype('float32')
+
+
+def _preprocess_chunk(args):
+    # (stats, start time, end time) of the chunk, timed in the worker
+    out_dir, file_name, start, images = args
+    start_time = time.time()
+    ray_trafo, FBPOper = _worker['ops']
+    volume = volume_memmaps(out_dir, file_name, mode='r+')
+    stats = Counter()
+    for i in range(images.shape[2]):
+        for array, data in zip(volume, preprocess_slice(images[:,:,i], ray_trafo, FBPOper, stats)):
+            array[...,start + i] = data
+    for array in volume:
+        array.flush()
+    return stats, start_time, time.time()
+
+
+def _pooled_volumes(test_path, file_names, workers, out_dir, impl, chunk, cache):
+    temporary = out_dir is None
+    out_dir = tempfile.mkdtemp(prefix='clinic_') if temporary else out_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    # spawn: a forked CUDA context (astra_cuda) is not usable in the children
+    pool = multiprocessing.get_context('spawn').Pool(workers, _init_worker, (impl,))
+
+    def submit(file_name):
+        key, hit = cache_lookup(cache, test_path+'/'+file_name, file_name, impl)
+        if hit is not None:
+            return key, hit[0], hit[1:], None
+        img = nibabel.load(test_path+'/'+file_name)
+        imag = img.get_fdata()  # imag with pixel as HU unit
         num_s = imag.shape[2]
-        M  = np.zeros((CTpara['imPixNum'], CTpara['imPixNum'], num_s), dtype='float32')
-        Xma = np.zeros_like(M)
-        XLI = np.zeros_like(M)
-        Tr = np.zeros((CTpara['sinogram_size_x'], CTpara['sinogram_size_y'], num_s), dtype='float32')
-        Sma = np.zeros_like(Tr)
-        SLI =  np.zeros_like(Tr)
-        for i in range(num_s):
-            image = np.array(Image.fromarray(imag[:,:,i]).resize((CTpara['imPixNum'], CTpara['imPixNum']), PIL.Image.BILINEAR))
-            image[image < -1000] = -1000
-            image = image / 1000 * 0.192 + 0.192
-            Xma[...,i] = image
-            [rowindex, colindex] = np.where(image > mask_thre)
-            M[rowindex, colindex, i] = 1
-            Pmetal_kev = np.asarray(ray_trafo(M[:,:,i]))
-            Tr[...,i] = Pmetal_kev > 0
-            Sma[...,i] = np.asarray(ray_trafo(image))
-            SLI[...,i] = interpolate_projection(Sma[...,i], Tr[...,i])
-            XLI[...,i] = np.asarray(FBPOper(SLI[...,i]))
+        volume_memmaps(out_dir, file_name, num_s, 'w+')
+        tasks = [(out_dir, file_name, s, imag[:,:,s:s + chunk]) for s in range(0, num_s, chunk)]
+        return key, img.affine, None, pool.map_async(_preprocess_chunk, tasks)
+
+    try:
+        pending = submit(file_names[0]) if file_names else None
+        for k, file_name in enumerate(file_names):
+            key, affine, volume, result = pending
+            if result is not None:
+                chunks = result.get()
+                # span of the chunks in the workers: excludes the time the volume waited for the consumer
+                seconds = max(end for _, _, end in chunks) - min(start for _, start, _ in chunks)
+                report(file_name, seconds, sum((stats for stats, _, _ in chunks), Counter()))
+            pending = submit(file_names[k + 1]) if k + 1 < len(file_names) else None
+            if volume is not None:  # from the cache
+                yield (file_name, affine) + volume
+                continue
+            volume = volume_memmaps(out_dir, file_name)
+            if cache is not None:
+                cache.store(key, affine, VOLUME_KEYS, volume)
+            yield (file_name, affine) + tuple(volume)
+            if temporary:
+                for key in VOLUME_KEYS:
+                    os.remove(os.path.join(out_dir, '{}_{}.npy'.format(file_name, key)))
+    finally:
+        pool.terminate()
+        if temporary:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def clinic_input_data(test_path, **kwargs):
+    # all volumes at once, as lists (allXma, allXLI, allM, allSma, allSLI, allTr, allaffine, allfilename)
+    allXma, allXLI, allM, allSma, allSLI, allTr, allaffine, allfilename = [], [], [], [], [], [], [], []
+    for file_name, affine, Xma, XLI, M, Sma, SLI, Tr in clinic_volumes(test_path, **kwargs):
         allXma.append(Xma)
         allXLI.append(XLI)
         allM.append(M)
         allSma.append(Sma)
         allSLI.append(SLI)
         allTr.append(Tr)
+        allaffine.append(affine)
         allfilename.append(file_name)
     return allXma, allXLI, allM, allSma, allSLI, allTr, allaffine, allfilename
 
 
-def interpolate_projection(proj, metalTrace):
-    # projection linear interpolation
-    # Input:
-    # proj:         uncorrected projection
-    # metalTrace:   metal trace in projection domain (binary image)
-    # Output:
-    # Pinterp:      linear interpolation corrected projection
-    Pinterp = proj.copy()
-    for i in range(Pinterp.shape[0]):
-        mslice = metalTrace[i]
-        pslice = Pinterp[i]
-
-        metalpos = np.nonzero(mslice==1)[0]
-        nonmetalpos = np.nonzero(mslice==0)[0]
-        pnonmetal = pslice[nonmetalpos]
-        pslice[metalpos] = interp1d(nonmetalpos,pnonmetal)(metalpos)
-        Pinterp[i] = pslice
-
-    return Pinterp
+if __name__ == '__main__':
+    # python -m CLINIC_metal.preprocess_clinic.preprocessing_clinic --data_path CLINIC_metal/test/ --out_dir CLINIC_metal/preprocessed/ --workers 8
+    parser = argparse.ArgumentParser(description='Preprocess CLINIC-metal volumes into memory-mappable .npy files')
+    parser.add_argument('--data_path', type=str, default='CLINIC_metal/test/', help='folder of .nii(.gz) volumes')
+    parser.add_argument('--out_dir', type=str, default='CLINIC_metal/preprocessed/', help='output folder of <volume>_<array>.npy')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='preprocessing processes')
+    parser.add_argument('--chunk', type=int, default=4, help='slices per task')
+    parser.add_argument('--impl', type=str, default='astra_cuda', choices=['astra_cuda', 'astra_cpu'])
+    parser.add_argument('--cache_dir', type=str, default=None, help='also fill the preprocessing cache read by test_clinic.py --preprocess_cache')
+    parser.add_argument('--cache_size', type=float, default=50, help='size bound of the preprocessing cache in GB')
+    opt = parser.parse_args()
+    tic = time.time()
+    num_s = 0
+    for file_name, affine, *volume in clinic_volumes(opt.data_path, opt.workers, opt.out_dir, opt.impl, opt.chunk,
+                                                     opt.cache_dir, int(opt.cache_size * 2 ** 30)):
+        num_s += volume[0].shape[2]
+    print('preprocessed {:d} slices in {:.2f}s, {:.2f} slices/s'.format(num_s, time.time() - tic, num_s / (time.time() - tic)))
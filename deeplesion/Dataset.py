@@ -1,8 +1,10 @@
 import os
 import os.path
+import json
 import numpy as np
 import random
 import h5py
+from collections import OrderedDict
 import torch
 import torch.utils.data as udata
 import PIL.Image as Image
@@ -10,30 +12,50 @@ from numpy.random import RandomState
 import scipy.io as sio
 import PIL
 from PIL import Image
-from .build_gemotry import initialization, build_gemotry
+from network.build_gemotry import get_operators
+from .build_gemotry import initialization
+from .preprocess import prepare
 
 param = initialization()
-ray_trafo = build_gemotry(param)
 
-def image_get_minmax():
-    return 0.0, 1.0
+class H5Handles(object):
+    """LRU of h5py files kept open for reading, bounding the number of file descriptors."""
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.files = OrderedDict()
 
-def proj_get_minmax():
-    return 0.0, 4.0
+    def get(self, path):
+        if path in self.files:
+            self.files.move_to_end(path)
+        else:
+            if len(self.files) >= self.max_open:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            self.files[path] = h5py.File(path, 'r')
+        return self.files[path]
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[1].close()
+
+
+def worker_init_fn(worker_id):
+    # every DataLoader worker opens its own handles instead of inheriting the parent's
+    dataset = udata.get_worker_info().dataset
+    if getattr(dataset, 'max_open_files', 0):
+        dataset.open_handles()
 
-def normalize(data, minmax):
-    data_min, data_max = minmax
-    data = np.clip(data, data_min, data_max)
-    data = (data - data_min) / (data_max - data_min)
-    data = data.astype(np.float32)
-    data = data*255.0
-    data = np.transpose(np.expand_dims(data, 2), (2, 0, 1))
-    return data
 
 class MARTrainDataset(udata.Dataset):
-    def __init__(self, dir, patchSize, mask):
+    def __init__(self, dir, patchSize, mask, projector='odl', precomputed_sgt=False, max_open_files=0, impl='astra_cuda'):
         super().__init__()
         self.dir = dir
+        self.projector = projector
+        self.impl = impl                        # astra implementation of the odl projector
+        self.precomputed_sgt = precomputed_sgt  # read Sgt.h5 written by deeplesion/precompute_sgt.py
+        self.max_open_files = max_open_files    # > 0: keep up to this many h5 files open per worker
+        self.handles = None
+        self.buffers = {}
         self.train_mask = mask
         self.patch_size = patchSize
         self.txtdir = os.path.join(self.dir, 'train_640geo_dir.txt')
@@ -43,6 +65,30 @@ class MARTrainDataset(udata.Dataset):
     def __len__(self):
         return self.file_num
 
+    def __getstate__(self):
+        # h5py handles cannot be pickled, workers reopen them lazily
+        state = self.__dict__.copy()
+        state['handles'] = None
+        state['buffers'] = {}
+        return state
+
+    def open_handles(self):
+        if self.handles is not None:
+            self.handles.close()
+        self.handles = H5Handles(self.max_open_files)
+        self.buffers = {}
+
+    def read(self, path, key):
+        # read straight into a buffer reused across samples, prepare() copies out of it
+        if self.handles is None:
+            self.open_handles()
+        dset = self.handles.get(path)[key]
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != dset.shape or buf.dtype != dset.dtype:
+            buf = self.buffers[key] = np.empty(dset.shape, dset.dtype)
+        dset.read_direct(buf)
+        return buf
+
     def __getitem__(self, idx):
         gt_dir = self.mat_files[idx]
         #random_mask = random.randint(0, 89)  # include 89
@@ -51,28 +97,111 @@ class MARTrainDataset(udata.Dataset):
         data_file = file_dir + str(random_mask) + '.h5'
         abs_dir = os.path.join(self.dir, 'train_640geo/', data_file)
         gt_absdir = os.path.join(self.dir,'train_640geo/', gt_dir[:-1])
-        gt_file = h5py.File(gt_absdir, 'r')
-        Xgt = gt_file['image'][()]
-        gt_file.close()
-        file = h5py.File(abs_dir, 'r')
-        Xma= file['ma_CT'][()]
-        Sma = file['ma_sinogram'][()]
-        XLI =file['LI_CT'][()]
-        SLI = file['LI_sinogram'][()]
-        Tr = file['metal_trace'][()]
-        file.close()
-        Sgt = np.asarray(ray_trafo(Xgt))
+        if self.max_open_files:
+            Xgt = self.read(gt_absdir, 'image')
+            Xma, Sma, XLI, SLI, Tr = [self.read(abs_dir, key) for key in
+                                      ('ma_CT', 'ma_sinogram', 'LI_CT', 'LI_sinogram', 'metal_trace')]
+        else:
+            gt_file = h5py.File(gt_absdir, 'r')
+            Xgt = gt_file['image'][()]
+            gt_file.close()
+            file = h5py.File(abs_dir, 'r')
+            Xma= file['ma_CT'][()]
+            Sma = file['ma_sinogram'][()]
+            XLI =file['LI_CT'][()]
+            SLI = file['LI_sinogram'][()]
+            Tr = file['metal_trace'][()]
+            file.close()
+        if self.precomputed_sgt and self.max_open_files:
+            # copied out of the reused read buffer, the samples of a batch must not share it
+            Sgt = np.array(self.read(os.path.join(os.path.dirname(gt_absdir), 'Sgt.h5'), 'Sgt')[np.newaxis])
+        elif self.precomputed_sgt:
+            sgt_file = h5py.File(os.path.join(os.path.dirname(gt_absdir), 'Sgt.h5'), 'r')
+            Sgt = sgt_file['Sgt'][()][np.newaxis]              # already normalized
+            sgt_file.close()
+        else:
+            Sgt = np.asarray(get_operators(param.param, self.projector, self.impl).ray_trafo(Xgt))
         M512 = self.train_mask[:,:,random_mask]
         M = np.array(Image.fromarray(M512).resize((416, 416), PIL.Image.BILINEAR))
-        Xma = normalize(Xma, image_get_minmax())
-        Xgt = normalize(Xgt, image_get_minmax())
-        XLI = normalize(XLI, image_get_minmax())
-        Sma = normalize(Sma, proj_get_minmax())
-        Sgt = normalize(Sgt, proj_get_minmax())
-        SLI = normalize(SLI, proj_get_minmax())
-        Tr = 1 -Tr.astype(np.float32)
-        Tr = np.transpose(np.expand_dims(Tr, 2), (2, 0, 1))
-        Mask = M.astype(np.float32)
-        Mask = np.transpose(np.expand_dims(Mask, 2), (2, 0, 1))
-        return torch.Tensor(Xma), torch.Tensor(XLI), torch.Tensor(Xgt), torch.Tensor(Mask), \
-               torch.Tensor(Sma), torch.Tensor(SLI), torch.Tensor(Sgt), torch.Tensor(Tr)
\ No newline at end of file
+        if self.precomputed_sgt:
+            Xma, XLI, Xgt, Sma, SLI, Tr, Mask = prepare((Xma, XLI, Xgt), (Sma, SLI), (Tr,), (M,))
+            Sgt = torch.Tensor(Sgt)
+        else:
+            Xma, XLI, Xgt, Sma, SLI, Sgt, Tr, Mask = prepare((Xma, XLI, Xgt), (Sma, SLI, Sgt), (Tr,), (M,))
+        return Xma, XLI, Xgt, Mask, Sma, SLI, Sgt, Tr
+
+class MARShardDataset(udata.Dataset):
+    """MARTrainDataset over the shards of deeplesion/pack_shards.py: memory-mapped, no per-sample file opens."""
+    def __init__(self, dir, patchSize, mask):
+        super().__init__()
+        self.dir = dir
+        self.train_mask = mask
+        self.patch_size = patchSize
+        with open(os.path.join(self.dir, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        self.num_variants = self.index['num_variants']
+        self.offsets = np.cumsum([0] + self.index['shards'])
+        self.file_num = int(self.offsets[-1])
+        self.arrays = None
+    def __len__(self):
+        return self.file_num
+
+    def __getstate__(self):
+        # memmaps are opened lazily in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def open(self):
+        self.arrays = []
+        for shard in range(len(self.index['shards'])):
+            self.arrays.append({name: np.load(os.path.join(self.dir, '{:05d}_{}.npy'.format(shard, name)), mmap_mode='r')
+                                for name in ('Xgt', 'Sgt', 'Xma', 'XLI', 'Sma', 'SLI', 'Tr')})
+
+    def __getitem__(self, idx):
+        if self.arrays is None:
+            self.open()
+        shard = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        i = idx - self.offsets[shard]
+        random_mask = random.randint(0, self.num_variants - 1)
+        arrays = self.arrays[shard]
+        M512 = self.train_mask[:,:,random_mask]
+        M = np.array(Image.fromarray(M512).resize((416, 416), PIL.Image.BILINEAR))
+        # the float16 memmap slices are converted while being copied into the float32 output block
+        Xma, XLI, Xgt, Sma, SLI, Sgt, Tr, Mask = prepare(
+            (arrays['Xma'][i, random_mask], arrays['XLI'][i, random_mask], arrays['Xgt'][i]),
+            (arrays['Sma'][i, random_mask], arrays['SLI'][i, random_mask], arrays['Sgt'][i]),
+            (arrays['Tr'][i, random_mask],), (M,))
+        return Xma, XLI, Xgt, Mask, Sma, SLI, Sgt, Tr
+
+class MARTestDataset(udata.Dataset):
+    """Every (test slice, metal mask) pair of deeplesion/test, in the order of test_deeplesion.py."""
+    def __init__(self, dir, mask, projector='odl', num_masks=10, impl='astra_cuda'):
+        super().__init__()
+        self.dir = dir
+        self.projector = projector
+        self.impl = impl                        # astra implementation of the odl projector
+        self.test_mask = mask
+        self.num_masks = num_masks  # 10 for the demo data, up to mask.shape[2]
+        self.txtdir = os.path.join(self.dir, 'test_640geo_dir.txt')
+        self.mat_files = [line for line in open(self.txtdir, 'r').readlines() if line.strip()]
+        self.file_num = len(self.mat_files) * self.num_masks
+    def __len__(self):
+        return self.file_num
+
+    def __getitem__(self, idx):
+        imag_idx, mask_idx = divmod(idx, self.num_masks)
+        gt_dir = self.mat_files[imag_idx]
+        data_file = gt_dir[:-6] + str(mask_idx) + '.h5'
+        abs_dir = os.path.join(self.dir, 'test_640geo/', data_file)
+        gt_absdir = os.path.join(self.dir, 'test_640geo/', gt_dir.strip())
+        with h5py.File(gt_absdir, 'r') as gt_file:
+            Xgt = gt_file['image'][()]
+        with h5py.File(abs_dir, 'r') as file:
+            Xma, Sma, XLI, SLI, Tr = [file[key][()] for key in
+                                      ('ma_CT', 'ma_sinogram', 'LI_CT', 'LI_sinogram', 'metal_trace')]
+        Sgt = np.asarray(get_operators(param.param, self.projector, self.impl).ray_trafo(Xgt))
+        M512 = self.test_mask[:,:,mask_idx]
+        M = np.array(Image.fromarray(M512).resize((416, 416), PIL.Image.BILINEAR))
+        Xma, XLI, Xgt, Sma, SLI, Sgt, Tr, Mask = prepare((Xma, XLI, Xgt), (Sma, SLI, Sgt), (Tr,), (M,))
+        return Xma, XLI, Xgt, Mask, Sma, SLI, Sgt, Tr
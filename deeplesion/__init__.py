@@ -1,2 +1,2 @@
-from .Dataset import MARTrainDataset
-from .build_gemotry import  initialization, build_gemotry
\ No newline at end of file
+from .Dataset import MARTrainDataset, MARShardDataset, MARTestDataset, worker_init_fn
+from .build_gemotry import  initialization
\ No newline at end of file
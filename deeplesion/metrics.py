@@ -0,0 +1,35 @@
+"""
+PSNR and SSIM of (B, 1, H, W) images in [0, 1] over the non-metal region, as used by
+test_deeplesion.py for the mixed-precision regression check (the reported numbers of the paper are
+computed with the OSCNet metric scripts, see README).
+"""
+import torch
+import torch.nn.functional as F
+
+
+def psnr(x, y, mask=None):
+    # per image, mask = 1 marks the metal pixels that are excluded
+    weight = torch.ones_like(x) if mask is None else 1 - mask
+    mse = ((x - y) ** 2 * weight).sum(dim=(1, 2, 3)) / weight.sum(dim=(1, 2, 3)).clamp(min=1)
+    return 10 * torch.log10(1 / mse.clamp(min=1e-10))
+
+
+def _gaussian_window(size=11, sigma=1.5, device=None):
+    coords = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return (g[:, None] * g[None, :])[None, None]
+
+
+def ssim(x, y, mask=None):
+    # per image, the SSIM map of an 11x11 Gaussian window averaged over the non-metal pixels
+    window = _gaussian_window(device=x.device)
+    C1, C2 = 0.01 ** 2, 0.03 ** 2
+    mu_x = F.conv2d(x, window, padding=5)
+    mu_y = F.conv2d(y, window, padding=5)
+    var_x = F.conv2d(x * x, window, padding=5) - mu_x ** 2
+    var_y = F.conv2d(y * y, window, padding=5) - mu_y ** 2
+    cov = F.conv2d(x * y, window, padding=5) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + C1) * (2 * cov + C2)) / ((mu_x ** 2 + mu_y ** 2 + C1) * (var_x + var_y + C2))
+    weight = torch.ones_like(x) if mask is None else 1 - mask
+    return (ssim_map * weight).sum(dim=(1, 2, 3)) / weight.sum(dim=(1, 2, 3)).clamp(min=1)
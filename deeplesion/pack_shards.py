@@ -0,0 +1,82 @@
+"""
+Pack deeplesion/train/train_640geo/ into a few large shards read by MARShardDataset.
+
+Every shard holds one contiguous .npy file per array, memory-mapped at training time:
+    <k>_Xgt.npy, <k>_Sgt.npy                          (n, H, W)      per gt slice
+    <k>_Xma.npy, <k>_XLI.npy, <k>_Sma.npy, <k>_SLI.npy (n, V, H, W)   per slice and metal mask
+    <k>_Tr.npy                                         (n, V, H, W)   uint8
+plus index.json with the shard sizes, the number of mask variants V and the slice names.
+Values are stored raw (as in the h5 files), normalization stays in the dataset.
+
+python -m deeplesion.pack_shards --data_path deeplesion/train/ --out_dir deeplesion/train_shards/ --projector torch
+"""
+import os
+import json
+import argparse
+import time
+import h5py
+import numpy as np
+from network.build_gemotry import get_operators
+from .build_gemotry import initialization
+from .precompute_sgt import gt_files
+
+SHARD_VERSION = 1
+IMAGE_KEYS = {'Xma': 'ma_CT', 'XLI': 'LI_CT', 'Sma': 'ma_sinogram', 'SLI': 'LI_sinogram', 'Tr': 'metal_trace'}
+
+
+def shard_file(out_dir, shard, name):
+    return os.path.join(out_dir, '{:05d}_{}.npy'.format(shard, name))
+
+
+def pack_shards(data_path, out_dir, split='train', num_variants=10, shard_size=256, dtype='float16', projector='odl',
+                impl='astra_cuda'):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    ray_trafo = get_operators(initialization().param, projector, impl).ray_trafo
+    files = gt_files(data_path, split)
+    shards = []
+    for shard, start in enumerate(range(0, len(files), shard_size)):
+        batch = files[start:start + shard_size]
+        n = len(batch)
+        arrays = {}
+        for name in ('Xgt', 'Sgt'):
+            shape = (416, 416) if name == 'Xgt' else (640, 641)
+            arrays[name] = np.lib.format.open_memmap(shard_file(out_dir, shard, name), 'w+', dtype, (n,) + shape)
+        for name in IMAGE_KEYS:
+            shape = (416, 416) if name[0] == 'X' else (640, 641)
+            arrays[name] = np.lib.format.open_memmap(shard_file(out_dir, shard, name), 'w+',
+                                                     np.uint8 if name == 'Tr' else dtype, (n, num_variants) + shape)
+        for i, gt_absdir in enumerate(batch):
+            with h5py.File(gt_absdir, 'r') as gt_file:
+                Xgt = gt_file['image'][()]
+            arrays['Xgt'][i] = Xgt
+            arrays['Sgt'][i] = np.asarray(ray_trafo(Xgt))
+            for v in range(num_variants):
+                with h5py.File(os.path.join(os.path.dirname(gt_absdir), '{}.h5'.format(v)), 'r') as file:
+                    for name, key in IMAGE_KEYS.items():
+                        arrays[name][i, v] = file[key][()]
+        for array in arrays.values():
+            array.flush()
+        shards.append(n)
+        print('shard {:d}: {:d} slices'.format(shard, n))
+    index = {'version': SHARD_VERSION, 'num_variants': num_variants, 'dtype': dtype, 'shards': shards,
+             'files': [os.path.relpath(f, data_path) for f in files]}
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the DeepLesion training h5 files into memory-mappable shards')
+    parser.add_argument('--data_path', type=str, default='deeplesion/train/', help='folder holding <split>_640geo_dir.txt')
+    parser.add_argument('--out_dir', type=str, default='deeplesion/train_shards/', help='output folder of the shards')
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'test'])
+    parser.add_argument('--num_variants', type=int, default=10, help='metal masks per slice (90 for the full dataset)')
+    parser.add_argument('--shard_size', type=int, default=256, help='gt slices per shard')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--projector', type=str, default='odl', choices=['odl', 'torch'])
+    parser.add_argument('--impl', type=str, default='astra_cuda', choices=['astra_cuda', 'astra_cpu'], help='astra implementation of --projector odl')
+    opt = parser.parse_args()
+    tic = time.time()
+    index = pack_shards(opt.data_path, opt.out_dir, opt.split, opt.num_variants, opt.shard_size, opt.dtype, opt.projector, opt.impl)
+    print('packed {:d} slices x {:d} variants in {:.2f}s'.format(len(index['files']), index['num_variants'], time.time() - tic))
@@ -0,0 +1,59 @@
+"""
+Forward-project every gt.h5 of a DeepLesion split once and store the normalized sinogram Sgt
+in a sidecar Sgt.h5 next to it, read by MARTrainDataset(..., precomputed_sgt=True) and
+test_deeplesion.py --precomputed_sgt instead of projecting Xgt on every fetch.
+
+python -m deeplesion.precompute_sgt --data_path deeplesion/train/ --split train --projector torch
+"""
+import os
+import argparse
+import time
+import h5py
+import numpy as np
+from network.build_gemotry import get_operators
+from .build_gemotry import initialization
+from .preprocess import normalize, proj_get_minmax
+
+SGT_FILE = 'Sgt.h5'
+
+
+def sgt_path(gt_absdir):
+    return os.path.join(os.path.dirname(gt_absdir), SGT_FILE)
+
+
+def gt_files(data_path, split):
+    txtdir = os.path.join(data_path, '{}_640geo_dir.txt'.format(split))
+    with open(txtdir, 'r') as f:
+        return [os.path.join(data_path, '{}_640geo/'.format(split), line.strip()) for line in f if line.strip()]
+
+
+def precompute_sgt(data_path, split='train', projector='odl', batch_size=8, overwrite=False, impl='astra_cuda'):
+    ray_trafo = get_operators(initialization().param, projector, impl).ray_trafo
+    todo = [gt for gt in gt_files(data_path, split) if overwrite or not os.path.exists(sgt_path(gt))]
+    # the torch projector handles a whole batch in one SpMM, odl projects one slice at a time
+    batch_size = batch_size if projector == 'torch' else 1
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        Xgt = []
+        for gt_absdir in batch:
+            with h5py.File(gt_absdir, 'r') as gt_file:
+                Xgt.append(gt_file['image'][()])
+        Sgt = np.asarray(ray_trafo(np.stack(Xgt))) if projector == 'torch' else np.asarray(ray_trafo(Xgt[0]))[None]
+        for gt_absdir, sgt in zip(batch, Sgt):
+            with h5py.File(sgt_path(gt_absdir), 'w') as f:
+                f.create_dataset('Sgt', data=normalize(sgt, proj_get_minmax())[0])
+    return len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute normalized Sgt sidecars for DeepLesion')
+    parser.add_argument('--data_path', type=str, default='deeplesion/train/', help='folder holding <split>_640geo_dir.txt')
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'test'])
+    parser.add_argument('--projector', type=str, default='odl', choices=['odl', 'torch'])
+    parser.add_argument('--impl', type=str, default='astra_cuda', choices=['astra_cuda', 'astra_cpu'], help='astra implementation of --projector odl')
+    parser.add_argument('--batch_size', type=int, default=8, help='slices per projection call (torch projector)')
+    parser.add_argument('--overwrite', action='store_true', help='recompute existing sidecars')
+    opt = parser.parse_args()
+    tic = time.time()
+    count = precompute_sgt(opt.data_path, opt.split, opt.projector, opt.batch_size, opt.overwrite, opt.impl)
+    print('wrote {:d} {} files in {:.2f}s'.format(count, SGT_FILE, time.time() - tic))
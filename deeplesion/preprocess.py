@@ -0,0 +1,126 @@
+"""
+Normalization and layout of the network inputs, shared by training (Dataset.py), test_deeplesion.py
+and test_clinic.py.
+
+prepare() converts all arrays of a sample, a batch or a whole volume in one go: one float32 block
+per domain is allocated (optionally on the target device) and filled in place, so there are no
+per-step temporaries (clip -> subtract -> divide -> astype -> x255 -> expand_dims -> transpose).
+
+python -m deeplesion.preprocess        # benchmark against the former per-array normalize()
+"""
+import time
+import warnings
+import numpy as np
+import torch
+
+
+def image_get_minmax():
+    return 0.0, 1.0
+
+
+def proj_get_minmax():
+    return 0.0, 4.0
+
+
+def normalize(data, minmax):
+    # (H, W) -> (1, H, W) float32 in [0, 255]
+    data_min, data_max = minmax
+    out = np.empty((1,) + np.shape(data), dtype=np.float32)
+    out[0] = data
+    np.clip(out, data_min, data_max, out=out)
+    if data_min:
+        out -= data_min
+    out *= 255.0 / (data_max - data_min)
+    return out
+
+
+def _fill(block, arrays, non_blocking):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # read-only memmaps are only read from
+        for i, data in enumerate(arrays):
+            block[i].copy_(data if torch.is_tensor(data) else torch.from_numpy(np.asarray(data)), non_blocking=non_blocking)
+
+
+def _scale(block, minmax):
+    data_min, data_max = minmax
+    block.clamp_(data_min, data_max)
+    if data_min:
+        block.sub_(data_min)
+    block.mul_(255.0 / (data_max - data_min))
+
+
+def prepare(images=(), projs=(), traces=(), masks=(), device=None, non_blocking=False, pin_memory=False):
+    """Network inputs from raw arrays, each (H, W) for one slice or (N, H, W) for a batch/volume.
+
+    images (Xma, XLI, Xgt, ...) and projs (Sma, SLI, Sgt, ...) are clipped and scaled to [0, 255],
+    traces become 1 - Tr and masks are cast to float. Returns float32 tensors of shape (1, H, W) or
+    (N, 1, H, W), in the order images, projs, traces, masks, as views of one block per domain.
+    pin_memory allocates the (host) blocks in page-locked memory for asynchronous copies to the GPU.
+    """
+    out = {}
+    for domain, arrays, extra, minmax in (('image', images, masks, image_get_minmax()),
+                                          ('proj', projs, traces, proj_get_minmax())):
+        items = list(arrays) + list(extra)
+        if not items:
+            out[domain] = []
+            continue
+        block = torch.empty((len(items),) + tuple(np.shape(items[0])), dtype=torch.float32, device=device,
+                            pin_memory=pin_memory)
+        _fill(block, items, non_blocking)
+        if arrays:
+            _scale(block[:len(arrays)], minmax)
+        if domain == 'proj' and extra:
+            block[len(arrays):].neg_().add_(1)
+        out[domain] = [block[i].unsqueeze(-3) for i in range(len(items))]
+    image_out, proj_out = out['image'], out['proj']
+    return tuple(image_out[:len(images)]) + tuple(proj_out[:len(projs)]) + \
+           tuple(proj_out[len(projs):]) + tuple(image_out[len(images):])
+
+
+def _legacy_normalize(data, minmax):
+    data_min, data_max = minmax
+    data = np.clip(data, data_min, data_max)
+    data = (data - data_min) / (data_max - data_min)
+    data = data.astype(np.float32)
+    data = data*255.0
+    data = np.transpose(np.expand_dims(data, 2), (2, 0, 1))
+    return data
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    Xma, XLI, Xgt = [rng.rand(416, 416).astype(np.float32) * 1.2 for _ in range(3)]
+    Sma, SLI, Sgt = [rng.rand(640, 641).astype(np.float32) * 5 for _ in range(3)]
+    Tr = (rng.rand(640, 641) > 0.9).astype(np.uint8)
+    M = (rng.rand(416, 416) > 0.99).astype(np.float32)
+
+    def legacy():
+        out = [_legacy_normalize(x, image_get_minmax()) for x in (Xma, XLI, Xgt)]
+        out += [_legacy_normalize(s, proj_get_minmax()) for s in (Sma, SLI, Sgt)]
+        Trn = np.transpose(np.expand_dims(1 - Tr.astype(np.float32), 2), (2, 0, 1))
+        Mask = np.transpose(np.expand_dims(M.astype(np.float32), 2), (2, 0, 1))
+        return [torch.Tensor(x) for x in out + [Trn, Mask]]
+
+    def fused():
+        return prepare((Xma, XLI, Xgt), (Sma, SLI, Sgt), (Tr,), (M,))
+
+    err = max((a - b).abs().max().item() for a, b in zip(legacy(), fused()))
+    for name, fn in (('legacy', legacy), ('prepare', fused)):
+        tic = time.time()
+        for _ in range(50):
+            fn()
+        print('{:8s} {:.2f} ms/sample'.format(name, (time.time() - tic) / 50 * 1000))
+    N = 32
+    vXma, vXLI = [np.stack([x] * N, axis=-1) for x in (Xma, XLI)]       # (H, W, N) as in clinic_input_data
+    vSma, vSLI, vTr = [np.stack([s] * N, axis=-1) for s in (Sma, SLI, Tr)]
+    tic = time.time()
+    for k in range(N):
+        [_legacy_normalize(x[..., k], image_get_minmax()) for x in (vXma, vXLI)]
+        [_legacy_normalize(s[..., k], proj_get_minmax()) for s in (vSma, vSLI)]
+        np.transpose(np.expand_dims(1 - vTr[..., k].astype(np.float32), 2), (2, 0, 1))
+    print('legacy   {:.2f} ms/slice on a {:d}-slice volume'.format((time.time() - tic) / N * 1000, N))
+    tic = time.time()
+    prepare([np.moveaxis(x, -1, 0) for x in (vXma, vXLI)], [np.moveaxis(s, -1, 0) for s in (vSma, vSLI)],
+            [np.moveaxis(vTr, -1, 0)])
+    print('prepare  {:.2f} ms/slice on a {:d}-slice volume'.format((time.time() - tic) / N * 1000, N))
+    print('max abs diff vs legacy {:.2e}'.format(err))
@@ -1,3 +1,3 @@
 from .indudonet import  InDuDoNet
 from .priornet import  UNet
-from .build_gemotry import  initialization, build_gemotry
\ No newline at end of file
+from .build_gemotry import  initialization, get_operators
@@ -0,0 +1,87 @@
+"""
+Time and peak memory of InDuDoNet inference and training steps.
+
+python -m network.benchmark --batch_sizes 1 2 4             # inference: every stage saved versus only the final one
+python -m network.benchmark --checkpoint_stages 0 1 2 5     # training step per checkpoint granularity
+python -m network.benchmark --coarse_stages 0 3 5           # inference and training time per coarse-to-fine schedule
+"""
+import time
+import argparse
+import multiprocessing
+import torch
+from .indudonet import InDuDoNet, para_ini
+
+
+def _peak_memory(args, batch_size, stages, device, checkpoint_stages=None):
+    # (seconds, increase of the peak memory in MB) of one inference forward, or of one training step
+    # (forward + backward) when checkpoint_stages is given
+    net = InDuDoNet(args).to(device)
+    if checkpoint_stages is None:
+        net.eval()
+    else:
+        net.checkpoint_stages = checkpoint_stages
+    image = torch.rand(batch_size, 1, para_ini.param['nx_h'], para_ini.param['ny_h'], device=device) * 255
+    proj = torch.rand(batch_size, 1, para_ini.param['nProj'], para_ini.param['nu_h'], device=device) * 255
+    inputs = (image, image.clone(), torch.zeros_like(image), proj, proj.clone(), torch.ones_like(proj))
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        import resource  # POSIX only, not needed on CUDA
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    tic = time.time()
+    if checkpoint_stages is None:
+        with torch.no_grad():
+            outputs = net(*inputs, stages=stages)
+    else:
+        ListX, ListS, ListYS = net(*inputs)
+        (ListX[-1].mean() + ListYS[-1].mean()).backward()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        return time.time() - tic, (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    return time.time() - tic, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base) / 2 ** 20
+
+
+if __name__ == '__main__':
+    # on CPU every measurement runs in a fresh process, so that ru_maxrss starts from the model alone
+    parser = argparse.ArgumentParser(description='Peak memory of inference (saved stages) and training (checkpointing)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--checkpoint_stages', type=int, nargs='*', default=None, help='training granularities to compare')
+    parser.add_argument('--coarse_stages', type=int, nargs='*', default=None, help='coarse-to-fine schedules to compare')
+    parser.add_argument('--coarse_factor', type=int, default=2, help='downsampling of the coarse geometry')
+    parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
+    parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
+    parser.add_argument('--S', type=int, default=10, help='the number of total iterative stages')
+    parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
+    parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
+    parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+    parser.add_argument('--projector', type=str, default='torch', choices=['odl', 'torch'])
+    args = parser.parse_args()
+    schedules = args.coarse_stages
+    args.coarse_stages = 0
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    def measure(*measure_args):
+        if device == 'cuda':
+            return _peak_memory(*measure_args)
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(_peak_memory, measure_args)
+
+    for batch_size in args.batch_sizes:
+        if schedules is not None:
+            for coarse_stages in schedules:
+                level_args = argparse.Namespace(**dict(vars(args), coarse_stages=coarse_stages))
+                inference = measure(level_args, batch_size, (-1,), device)[0]
+                step, peak = measure(level_args, batch_size, None, device, args.checkpoint_stages[0] if args.checkpoint_stages else 0)
+                print('batch {:d} ({}), coarse_stages {:d}: inference {:.2f} s, training {:.2f} s/step, peak {:.0f} MB'.format(
+                    batch_size, device, coarse_stages, inference, step, peak))
+            continue
+        if args.checkpoint_stages is None:
+            peaks = [measure(args, batch_size, stages, device)[1] for stages in (None, (-1,))]
+            print('batch {:d} ({}): all stages {:.0f} MB, final stage only {:.0f} MB'.format(batch_size, device, *peaks))
+            continue
+        for checkpoint_stages in args.checkpoint_stages:
+            seconds, peak = measure(args, batch_size, None, device, checkpoint_stages)
+            print('batch {:d} ({}), checkpoint_stages {:d}: {:.2f} s/step, peak {:.0f} MB'.format(
+                batch_size, device, checkpoint_stages, seconds, peak))
@@ -1,4 +1,6 @@
-import odl
+import os
+import sys
+import hashlib
 import numpy as np
 
 
@@ -29,7 +31,20 @@ class initialization:
         self.param['u_water'] = 0.192
 
 
-def build_gemotry(param):
+def downsample(param, factor):
+    """initialization().param of the same scanner at 1/factor of the image size, views and detector bins
+    (e.g. 208x208 images, 320 views and 321 bins for factor 2); the field of view and the distances are kept."""
+    param = dict(param)
+    param['nx_h'] //= factor
+    param['ny_h'] //= factor
+    param['nProj'] //= factor
+    param['nu_h'] = (param['nu_h'] - 1) // factor + 1
+    return param
+
+
+def _ray_transform(param, impl='astra_cuda'):
+    import odl
+    param = param if isinstance(param, initialization) else _Param(param)
     reco_space_h = odl.uniform_discr(
         min_pt=[-param.param['sx'] / 2.0, -param.param['sy'] / 2.0],
         max_pt=[param.param['sx'] / 2.0, param.param['sy'] / 2.0], shape=[param.param['nx_h'], param.param['ny_h']],
@@ -45,5 +60,97 @@ def build_gemotry(param):
                                           src_radius=param.param['dso'],
                                           det_radius=param.param['dde'])
 
-    ray_trafo_hh = odl.tomo.RayTransform(reco_space_h, geometry_h, impl='astra_cuda')
+    ray_trafo_hh = odl.tomo.RayTransform(reco_space_h, geometry_h, impl=impl)
     return ray_trafo_hh
+
+
+class _Param:
+    def __init__(self, param):
+        self.param = param
+
+
+def geometry_key(param):
+    # stable hash of an initialization().param dict, identical dicts share their operators
+    items = ';'.join('{}={!r}'.format(k, float(param[k])) for k in sorted(param))
+    return hashlib.sha1(items.encode('utf-8')).hexdigest()[:16]
+
+
+class GeometryOperators:
+    """fp, fp.adjoint and fbp of one geometry, each built on first use."""
+    def __init__(self, param, backend='odl', impl='astra_cuda', cache_dir=None):
+        self.param = dict(param)
+        self.key = geometry_key(param)
+        self.backend = backend
+        self.impl = impl
+        self.cache_dir = cache_dir
+        self._ray_trafo = None
+        self._fbp = None
+        self._modules = None
+
+    @property
+    def ray_trafo(self):
+        # numpy in / numpy-convertible out, as odl.tomo.RayTransform
+        if self._ray_trafo is None:
+            if self.backend == 'odl':
+                self._ray_trafo = _ray_transform(self.param, self.impl)
+            elif self.backend == 'torch':
+                self._ray_trafo = self._fanbeam()
+            else:
+                raise ValueError('Unknown projector backend: {}'.format(self.backend))
+        return self._ray_trafo
+
+    @property
+    def fbp(self):
+        if self._fbp is None:
+            if self.backend != 'odl':
+                return get_operators(self.param, 'odl', self.impl, self.cache_dir).fbp
+            import odl
+            self._fbp = odl.tomo.fbp_op(self.ray_trafo, filter_type='Ram-Lak', frequency_scaling=1.0)
+        return self._fbp
+
+    @property
+    def modules(self):
+        # (fp, fp.adjoint) as torch modules acting on (B, 1, H, W) tensors
+        if self._modules is None:
+            if self.backend == 'odl':
+                from odl.contrib import torch as odl_torch
+                self._modules = (odl_torch.OperatorModule(self.ray_trafo),
+                                 odl_torch.OperatorModule(self.ray_trafo.adjoint))
+            else:
+                from .projector import ProjectorModule
+                self._modules = (ProjectorModule(self.ray_trafo), ProjectorModule(self.ray_trafo, adjoint=True))
+        return self._modules
+
+    def _fanbeam(self):
+        from .projector import FanBeamProjector
+        if self.cache_dir is None:
+            return FanBeamProjector(self.param)
+        return FanBeamProjector.cached(self.param, self.cache_dir)
+
+
+operators = {}
+
+
+def get_operators(param, backend='odl', impl='astra_cuda', cache_dir=None):
+    """Per-process registry of GeometryOperators keyed by the initialization().param dict.
+
+    cache_dir (default: $INDUDONET_GEOMETRY_CACHE) holds the versioned system-matrix cache of the torch
+    projector (see network/projector.py), memory-mapped by later processes instead of rebuilt.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('INDUDONET_GEOMETRY_CACHE')
+    key = (geometry_key(param), backend, impl)
+    if key not in operators:
+        operators[key] = GeometryOperators(param, backend, impl, cache_dir)
+    return operators[key]
+
+
+def select_astra_gpu(device):
+    """Run the astra_cuda projections of this process and of its DataLoader workers on the GPU of device
+    (torch.device); astra itself always starts on GPU 0."""
+    if device.type != 'cuda' or device.index is None:
+        return
+    # astra reads ASTRA_GPU_INDEX when it is imported (by odl, in this process or in a spawned worker)
+    os.environ['ASTRA_GPU_INDEX'] = str(device.index)
+    if 'astra' in sys.modules:
+        sys.modules['astra'].set_gpu_index(device.index)
@@ -0,0 +1,136 @@
+"""
+Inference-only export of InDuDoNet with the native fan-beam projector.
+
+The ODL operator modules (and the autograd Functions of the torch projector) cannot be traced, so the
+projection operators are replaced by ExportProjector modules holding the system matrix as sparse CSR
+buffers, and the unrolled network is traced into one TorchScript module returning the final image X_S.
+The artifact (about 1 GB, mostly the system matrix and its transpose) is loaded with torch.jit.load
+alone, without ODL or astra:
+
+    net = torch.jit.load('indudonet_ts.pt', map_location='cuda')
+    X = net(Xma, XLI, M, Sma, SLI, Tr)        # inputs as prepared by deeplesion.preprocess.prepare
+
+python -m network.export --model_dir pretrained_model/InDuDoNet_latest.pt --output indudonet_ts.pt --benchmark
+"""
+import os
+import copy
+import time
+import argparse
+import warnings
+import torch
+import torch.nn as nn
+from .build_gemotry import initialization, get_operators, downsample, select_astra_gpu
+from .projector import project, project_transpose
+from .indudonet import InDuDoNet
+from .fuse import fold_batchnorm
+
+
+class ExportProjector(nn.Module):
+    """fp (or fp.adjoint) on (B, 1, H, W) tensors with the system matrix as a buffer, traceable."""
+    def __init__(self, projector, adjoint=False):
+        super(ExportProjector, self).__init__()
+        self.nsym, self.nbase, self.nu = projector.nsym, projector.nbase, projector.nu
+        self.nx, self.ny = projector.nx, projector.ny
+        self.scale = projector.scale
+        self.is_adjoint = adjoint
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # read-only memmaps of the geometry cache
+            matrix = projector.transpose() if adjoint else projector.operands('cpu')
+            # own the memory, the artifact must not depend on the cache files
+            matrix = torch.sparse_csr_tensor(matrix.crow_indices().clone(), matrix.col_indices().clone(),
+                                             matrix.values().clone(), size=matrix.shape)
+        self.register_buffer('matrix', matrix)
+
+    def forward(self, input):
+        if self.is_adjoint:
+            return project_transpose(self.matrix, input, self.nsym, self.nx, self.ny) * self.scale
+        return project(self.matrix, input, self.nsym, self.nbase, self.nu)
+
+
+class InferenceModel(nn.Module):
+    """InDuDoNet returning only the final image, with exportable projection operators."""
+    def __init__(self, net):
+        super(InferenceModel, self).__init__()
+        projector = get_operators(initialization().param, 'torch').ray_trafo
+        # shallow copy with its own submodule table: parameters are shared, the operators of net are kept
+        net = copy.copy(net)
+        net._modules = net._modules.copy()
+        net.op_modfp = ExportProjector(projector)
+        net.op_modpT = ExportProjector(projector, adjoint=True)
+        if net.coarse_stages > 0:
+            projector = get_operators(downsample(initialization().param, net.coarse_factor), 'torch').ray_trafo
+            net.op_modfp_coarse = ExportProjector(projector)
+            net.op_modpT_coarse = ExportProjector(projector, adjoint=True)
+        self.net = net
+
+    def forward(self, Xma, XLI, M, Sma, SLI, Tr):
+        ListX, ListS, ListYS = self.net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,))
+        return ListX[-1]
+
+
+def example_inputs(batch_size=1, device='cpu'):
+    param = initialization().param
+    image = torch.rand(batch_size, 1, param['nx_h'], param['ny_h'], device=device) * 255
+    proj = torch.rand(batch_size, 1, param['nProj'], param['nu_h'], device=device) * 255
+    M = torch.zeros_like(image)
+    Tr = torch.ones_like(proj)
+    return image, image.clone(), M, proj, proj.clone(), Tr
+
+
+def export_model(net, output, batch_size=1):
+    """Trace a trained InDuDoNet (any projector backend) into a TorchScript file; returns the traced module."""
+    model = InferenceModel(net).eval()
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # beta sparse CSR support
+        traced = torch.jit.trace(model, example_inputs(batch_size), check_trace=False)
+    traced.save(output)
+    return traced
+
+
+def benchmark(fn, inputs, repeat):
+    with torch.no_grad():
+        fn(*inputs)
+        tic = time.time()
+        for _ in range(repeat):
+            out = fn(*inputs)
+        if out.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - tic) / repeat, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export InDuDoNet to TorchScript with the native projector')
+    parser.add_argument('--model_dir', type=str, default=None, help='checkpoint to export (default: random weights)')
+    parser.add_argument('--output', type=str, default='indudonet_ts.pt', help='TorchScript file')
+    parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
+    parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
+    parser.add_argument('--S', type=int, default=10, help='the number of total iterative stages')
+    parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
+    parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
+    parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+    parser.add_argument('--fold_bn', action='store_true', help='fold the BatchNorm layers into the convolutions before exporting')
+    parser.add_argument('--benchmark', action='store_true', help='compare eager and TorchScript latency on CPU')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of the benchmark')
+    parser.add_argument('--device', type=str, default='cpu', help='device of the --benchmark runs, e.g. cpu or cuda (the export itself is traced on CPU)')
+    opt = parser.parse_args()
+    opt.projector = 'torch'
+    select_astra_gpu(torch.device(opt.device))
+    net = InDuDoNet(opt)
+    if opt.model_dir is not None:
+        net.load_state_dict(torch.load(os.path.join(opt.model_dir), map_location='cpu'))
+    net.eval()
+    if opt.fold_bn:
+        fold_batchnorm(net)
+    tic = time.time()
+    export_model(net, opt.output)
+    print('exported {} ({:.1f} MB) in {:.2f}s'.format(opt.output, os.path.getsize(opt.output) / 2 ** 20, time.time() - tic))
+    if opt.benchmark:
+        device = torch.device(opt.device)
+        net.to(device)
+        inputs = example_inputs(device=device)
+        t_eager, out_eager = benchmark(lambda *x: net(*x)[0][-1], inputs, opt.repeat)
+        scripted = torch.jit.load(opt.output, map_location=device)
+        t_script, out_script = benchmark(scripted, inputs, opt.repeat)
+        print('eager      {:.3f} s/slice'.format(t_eager))
+        print('torchscript {:.3f} s/slice'.format(t_script))
+        print('max abs diff {:.2e}'.format((out_eager - out_script).abs().max().item()))
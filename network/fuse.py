@@ -0,0 +1,90 @@
+"""
+BatchNorm folding for a frozen inference model.
+
+Every Conv2d -> BatchNorm2d pair inside an nn.Sequential (the ResBlocks of CTnet / Projnet and the
+double_conv blocks of the UNet priornet) is replaced by one convolution with the BN scale and shift
+folded into its weight and bias, and the BN slot by nn.Identity, so the module indices and the
+forward code stay unchanged. The ReLUs that follow run in place on the fresh convolution outputs.
+The standalone InDuDoNet.bn (not preceded by a convolution) is kept.
+
+python -m network.fuse --S 2        # max relative difference and eager latency before / after folding
+"""
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batchnorm(model):
+    """Fold the BN layers of model in place (the model becomes inference-only) and return it."""
+    model.eval()
+    folded = 0
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module)):
+            layer = module[i]
+            if isinstance(layer, nn.Conv2d) and i + 1 < len(module) and isinstance(module[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(layer, module[i + 1])
+                module[i + 1] = nn.Identity()
+                folded += 1
+            elif isinstance(layer, nn.ReLU):
+                layer.inplace = True
+    model.folded_batchnorms = folded
+    return model
+
+
+if __name__ == '__main__':
+    from .indudonet import InDuDoNet
+    from .build_gemotry import select_astra_gpu
+    parser = argparse.ArgumentParser(description='Check and time BatchNorm folding on a randomly initialized InDuDoNet')
+    parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
+    parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
+    parser.add_argument('--S', type=int, default=10, help='the number of total iterative stages')
+    parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
+    parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
+    parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+    parser.add_argument('--projector', type=str, default='torch', choices=['odl', 'torch'])
+    parser.add_argument('--repeat', type=int, default=2, help='timed runs')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model and the tensors, e.g. cuda, cuda:1 or cpu')
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+    select_astra_gpu(device)
+    torch.manual_seed(0)
+    net = InDuDoNet(opt)
+    for m in net.modules():
+        if isinstance(m, nn.BatchNorm2d):  # non-trivial statistics, as after training
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+    net.to(device).eval()
+    folded = fold_batchnorm(copy.deepcopy(net))
+    image = torch.rand(1, 1, 416, 416, device=device) * 255
+    proj = torch.rand(1, 1, 640, 641, device=device) * 255
+    inputs = (image, image.clone(), torch.zeros_like(image), proj, proj.clone(), torch.ones_like(proj))
+
+    def timed(fn, *args):
+        with torch.no_grad():
+            fn(*args)
+            tic = time.time()
+            for _ in range(opt.repeat):
+                out = fn(*args)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+        return (time.time() - tic) / opt.repeat, out
+
+    print('folded {:d} BatchNorm layers'.format(folded.folded_batchnorms))
+    for name, get, shape in (('Projnet', lambda m: m.proxNet_Sall[0], (1, opt.num_channel + 1, 640, 641)),
+                             ('CTnet', lambda m: m.proxNet_Xall[0], (1, opt.num_channel + 1, 416, 416)),
+                             ('UNet', lambda m: m.priornet, (1, 2, 416, 416))):
+        x = torch.rand(shape, device=device)
+        t_bn, _ = timed(get(net), x)
+        t_folded, _ = timed(get(folded), x)
+        print('{:8s} with BN {:.3f} s, folded {:.3f} s'.format(name, t_bn, t_folded))
+    t_bn, out_bn = timed(lambda *x: net(*x, stages=(-1,))[0][-1], *inputs)
+    t_folded, out_folded = timed(lambda *x: folded(*x, stages=(-1,))[0][-1], *inputs)
+    print('InDuDoNet with BN {:.3f} s/slice, folded {:.3f} s/slice, max relative diff {:.2e}'.format(
+        t_bn, t_folded, ((out_bn - out_folded).abs().max() / out_bn.abs().max()).item()))
@@ -3,18 +3,62 @@ MICCAI2021: ``InDuDoNet: An Interpretable Dual Domain Network for CT Metal Artif
 paper link： https://arxiv.org/pdf/2109.05298.pdf
 """
 import os
+import contextlib
+from collections import namedtuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as  F
-from odl.contrib import torch as odl_torch
+from torch.utils.checkpoint import checkpoint
 from .priornet import UNet
 import sys
 #sys.path.append("deeplesion/")
-from .build_gemotry import initialization, build_gemotry
+from .build_gemotry import initialization, get_operators, downsample
 para_ini = initialization()
-fp = build_gemotry(para_ini)
-op_modfp = odl_torch.OperatorModule(fp)
-op_modpT = odl_torch.OperatorModule(fp.adjoint)
+
+AMP_DTYPES = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device_type, amp='none'):
+    # mixed precision of the ProxNets and the PriorNet, see InDuDoNet.forward for what stays in fp32
+    return torch.autocast(device_type, dtype=AMP_DTYPES[amp] or torch.float32, enabled=amp != 'none')
+
+
+def full_precision(tensor):
+    # projections and the gradient steps GS / GX run in fp32 also under autocast
+    return torch.autocast(tensor.device.type, enabled=False)
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    # the recomputation of a checkpointed segment in the backward pass must not count its batch a second time
+    # in the BatchNorm running statistics: momentum 0 keeps them (they are updated in place and saved for the
+    # backward pass, so they cannot be restored afterwards), num_batches_tracked is restored
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def projection_operators(backend='odl', factor=1, impl='astra_cuda'):
+    # fp / fp.adjoint as torch modules: 'odl' wraps the astra RayTransform (impl), 'torch' is the native sparse projector;
+    # factor > 1: the geometry downsampled by factor (coarse stages)
+    param = para_ini.param if factor == 1 else downsample(para_ini.param, factor)
+    return get_operators(param, backend, impl).modules
+
+
+def resize(tensor, size):
+    # bilinear resampling between the resolution levels, cell-centred like the geometry partitions
+    return F.interpolate(tensor, size=size, mode='bilinear', align_corners=False)
+
+# final state of a forward pass (image, sinogram and their auxiliary variables, normalized prior sinogram Y),
+# to initialize the next slice of a volume from, see InDuDoNet.forward(warm=...)
+WarmState = namedtuple('WarmState', ['X', 'XZ', 'S', 'SZ', 'Y'])
 
 filter = torch.FloatTensor([[1.0, 1.0, 1.0], [1.0, 1.0, 1.0], [1.0, 1.0, 1.0]]) / 9  # for initialization
 filter = filter.unsqueeze(dim=0).unsqueeze(dim=0)
@@ -27,6 +71,21 @@ class InDuDoNet (nn.Module):
         self.num_u = args.num_channel + 1         # concat extra 1 term
         self.num_f = args.num_channel + 2         # concat extra 2 terms
         self.T = args.T
+        # the odl backend runs astra on the device the model is used on (args.device, default cuda if available)
+        device = getattr(args, 'device', 'cuda' if torch.cuda.is_available() else 'cpu')
+        impl = 'astra_cpu' if str(device).startswith('cpu') else 'astra_cuda'
+        self.op_modfp, self.op_modpT = projection_operators(getattr(args, 'projector', 'odl'), impl=impl)
+        self.checkpoint_stages = getattr(args, 'checkpoint_stages', 0) or 0  # stages per checkpointed segment, 0: off
+        # coarse-to-fine: the initialization and stages 1..coarse_stages run with the geometry downsampled by
+        # coarse_factor, the later stages at full resolution
+        self.coarse_stages = min(getattr(args, 'coarse_stages', 0) or 0, self.S)
+        self.coarse_factor = getattr(args, 'coarse_factor', 2)
+        if self.coarse_stages > 0:
+            self.op_modfp_coarse, self.op_modpT_coarse = projection_operators(getattr(args, 'projector', 'odl'),
+                                                                              self.coarse_factor, impl)
+            coarse_param = downsample(para_ini.param, self.coarse_factor)
+            self.coarse_image = [coarse_param['nx_h'], coarse_param['ny_h']]     # sizes of the coarse projectors
+            self.coarse_proj = [coarse_param['nProj'], coarse_param['nu_h']]
 
         # stepsize
         self.eta1const = args.eta1
@@ -55,16 +114,16 @@ class InDuDoNet (nn.Module):
 
         # Initialization S-domain by convoluting on XLI and SLI, respectively
         self.CX_const = filter.expand(args.num_channel, 1, -1, -1)
-        self.CX = nn.Parameter(self.CX_const, requires_grad=True)
+        self.CX = nn.Parameter(self.CX_const.clone(), requires_grad=True)          # own memory, not an expanded view
         self.CS_const = filter.expand(args.num_channel, 1, -1, -1)
-        self.CS = nn.Parameter(self.CS_const, requires_grad=True)
+        self.CS = nn.Parameter(self.CS_const.clone(), requires_grad=True)
 
         self.bn = nn.BatchNorm2d(1)
 
     def make_coeff(self, iters,const):
         const_dimadd = const.unsqueeze(dim=0)
         const_f = const_dimadd.expand(iters,-1)
-        coeff = nn.Parameter(data=const_f, requires_grad = True)
+        coeff = nn.Parameter(data=const_f.clone(), requires_grad = True)   # one value per stage, not an expanded view
         return coeff
 
     def make_Xnet(self, iters, channel, T):  #
@@ -79,78 +138,167 @@ class InDuDoNet (nn.Module):
             layers.append(Projnet(channel, T))
         return nn.Sequential(*layers)
 
-    def forward(self, Xma, XLI, M, Sma, SLI, Tr):
+    def kept_stages(self, stages):
+        # stage numbers 0..S (0: initialization, S: final) to save, negative numbers count from S
+        if stages is None:
+            return set(range(self.S + 1))
+        return set(k % (self.S + 1) for k in stages)
+
+    def forward(self, Xma, XLI, M, Sma, SLI, Tr, stages=None, max_stages=None, tol=None, warm=None, roi=None):
+        # stages=None saves every stage (training); for inference e.g. stages=(-1,) keeps only the final
+        # X, S and Y*S, so the intermediate results are freed as the stages go.
+        # max_stages / tol (inference): early exit after max_stages stages, or per sample as soon as the relative
+        # change of X between two stages falls below tol; returns [X], [S], [Y*S] of the final stage, the
+        # number of stages run by every sample and the final WarmState.
+        # warm (inference): WarmState of the neighbouring slices (same batch size) replacing proxNet_X0 /
+        # proxNet_S0 (and the PriorNet unless warm.Y is None); only the last max_stages stages are run.
+        # roi (inference): network.roi.TileROI, the CTnet of the stages after roi.full_stages only refines
+        # the tiles around the dilated metal mask M
+        adaptive = max_stages is not None or tol is not None or warm is not None
+        if adaptive and stages is not None:
+            raise ValueError('max_stages, tol and warm always return the final stage only, stages must be None')
+        keep = self.kept_stages(stages)
         # save mid-updating results
         ListS = []                # saving the reconstructed normalized sinogram
         ListX = []                # saving the reconstructed  CT image
         ListYS = []                # saving the reconstructed sinogram
 
+        coarse = self.coarse_stages > 0
+        if coarse and adaptive:
+            raise ValueError('coarse_stages is not supported together with max_stages, tol or warm')
+        if coarse:
+            image_size, proj_size = XLI.shape[-2:], SLI.shape[-2:]
+            X, XZ, S, SZ = self.initialize(resize(XLI, self.coarse_image), resize(SLI, self.coarse_proj))
+        elif warm is None:
+            X, XZ, S, SZ = self.initialize(XLI, SLI)
+        else:
+            if warm.X.shape[0] != XLI.shape[0]:
+                raise ValueError('warm state of {:d} samples for a batch of {:d}'.format(warm.X.shape[0], XLI.shape[0]))
+            X, XZ, S, SZ = warm.X, warm.XZ, warm.S, warm.SZ
+        if 0 in keep:
+            ListS.append(resize(S, proj_size) if coarse else S)
+
+        if warm is not None and warm.Y is not None:
+            Y = warm.Y
+        else:
+            Y = self.prior(Xma, XLI)
+
+        if adaptive:
+            if roi is not None:
+                raise ValueError('roi is not supported together with max_stages, tol or warm')
+            num_stages = min(max_stages or self.S, self.S)
+            first = self.S - num_stages if warm is not None else 0   # a warm start runs the last stages
+            X, XZ, S, SZ, stages_used = self.run_adaptive(first, first + num_stages, X, XZ, S, SZ, Y, Sma, Tr, tol)
+            return [X], [S], [Y * S], stages_used, WarmState(X, XZ, S, SZ, Y)
+
+        # iterative stages 1..S; with checkpoint_stages = k > 0 (training only) every k consecutive stages form
+        # one checkpointed segment whose activations are recomputed in the backward pass
+        use_checkpoint = self.checkpoint_stages > 0 and self.training and torch.is_grad_enabled()
+        segment = self.checkpoint_stages if use_checkpoint else 1
+        tiles = roi.tiles(M, 2 * self.T) if roi is not None else None   # halo: receptive field of CTnet
+        # segments do not cross the switch from the coarse to the full resolution
+        starts = sorted(set(range(0, self.S, segment)) | ({self.coarse_stages} if coarse else set()) - {self.S})
+        for start, stop in zip(starts, starts[1:] + [self.S]):
+            level = coarse and start < self.coarse_stages
+            if level:
+                Ylevel, Smalevel, Trlevel = [resize(t, self.coarse_proj) for t in (Y, Sma, Tr)]
+            else:
+                Ylevel, Smalevel, Trlevel = Y, Sma, Tr
+                if coarse and start == self.coarse_stages:
+                    X, XZ = resize(X, image_size), resize(XZ, image_size)
+                    S, SZ = resize(S, proj_size), resize(SZ, proj_size)
+            if use_checkpoint:
+                out = checkpoint(self.run_stages, start, stop, X, XZ, S, SZ, Ylevel, Smalevel, Trlevel,
+                                 coarse=level, use_reentrant=False,
+                                 context_fn=lambda: (contextlib.nullcontext(), frozen_batchnorm_stats(self)))
+            else:
+                out = self.run_stages(start, stop, X, XZ, S, SZ, Ylevel, Smalevel, Trlevel, tiles,
+                                      roi.full_stages if roi is not None else 0, coarse=level)
+            XZ, SZ = out[0], out[1]
+            for k, (X, S) in enumerate(zip(out[2::2], out[3::2]), start + 1):
+                if k in keep:
+                    # the saved stages are at full resolution
+                    ListS.append(resize(S, proj_size) if level else S)
+                    ListYS.append(Y * ListS[-1])
+                    ListX.append(resize(X, image_size) if level else X)
+        return ListX, ListS, ListYS
+
+    def initialize(self, XLI, SLI):
         # with the channel concatenation and detachment operator (refer to https://github.com/hongwang01/RCDNet) for initializing dual-domain
         XZ00 = F.conv2d(XLI,  self.CX, stride=1, padding=1)
         input_Xini = torch.cat((XLI, XZ00), dim=1)             #channel concatenation
         XZ_ini = self.proxNet_X0(input_Xini)
-        X0 = XZ_ini[:, :1, :, :]                              #channel detachment
+        X0 = XZ_ini[:, :1, :, :].float()                      #channel detachment
         XZ = XZ_ini[:, 1:, :, :]                              #auxiliary variable in image domain
-        X = X0                                                # the initialized CT image
 
         SZ00 = F.conv2d(SLI, self.CS, stride=1, padding=1)
         input_Sini = torch.cat((SLI, SZ00), dim=1)
         SZ_ini = self.proxNet_S0(input_Sini)
-        S0 = SZ_ini[:, :1, :, :]
+        S0 = SZ_ini[:, :1, :, :].float()
         SZ = SZ_ini[:, 1:, :, :]                               # auxiliary variable in sinogram domain
-        S = S0                                                 # the initialized normalized sinogram
-        ListS.append(S)
+        return X0, XZ, S0, SZ                                  # the initialized CT image and normalized sinogram
 
+    def prior(self, Xma, XLI):
         # PriorNet
         prior_input = torch.cat((Xma, XLI), dim=1)
         Xs = XLI + self.priornet(prior_input)
-        Y = op_modfp(F.relu(self.bn(Xs)) / 255)
-        Y = Y / 4.0 * 255                                     #normalized coefficients
-
-        # 1st iteration: Updating X0, S0-->S1
-        PX= op_modfp(X/255)/ 4.0 * 255
-        GS = Y * (Y*S - PX) + self.alphaS[0]*Tr * Tr * Y * (Y * S - Sma)
-        S_next = S - self.eta1S[0]/10*GS
-        inputS = torch.cat((S_next, SZ), dim=1)
-        outS = self.proxNet_Sall[0](inputS)
-        S = outS[:,:1,:,:]                                     # the updated normalized sinogram at the 1th stage
-        SZ =  outS[:,1:,:,:]
-        ListS.append(S)
-        ListYS.append(Y*S)
-
-        # 1st iteration: Updating X0, S1-->X1
-        ESX = PX - Y*S
-        GX = op_modpT((ESX/255) * 4.0)
-        X_next = X - self.eta2S[0] / 10 * GX
-        inputX = torch.cat((X_next, XZ), dim=1)
-        outX = self.proxNet_Xall[0](inputX)
-        X = outX[:, :1, :, :]                                              # the updated CT image at the 1th stage
-        XZ = outX[:, 1:, :, :]
-        ListX.append(X)
-
-        for i in range(self.iter):
+        with full_precision(Xs):
+            Y = self.op_modfp(F.relu(self.bn(Xs.float())) / 255)
+            Y = Y / 4.0 * 255                                 #normalized coefficients
+        return Y
 
+    def run_stages(self, start, stop, X, XZ, S, SZ, Y, Sma, Tr, tiles=None, full_stages=0, coarse=False):
+        # stages start+1..stop, returning (XZ, SZ, X_start+1, S_start+1, ..., X_stop, S_stop);
+        # with tiles (network.roi.Tiles) the CTnet of the stages after full_stages only runs on the tiles;
+        # coarse: the inputs are at the downsampled resolution and use its projectors
+        fp, pT = (self.op_modfp_coarse, self.op_modpT_coarse) if coarse else (self.op_modfp, self.op_modpT)
+        outputs = []
+        for i in range(start, stop):
             # updating S
-            PX = op_modfp(X / 255) / 4.0 * 255
-            GS = Y * (Y * S - PX)  + self.alphaS[i+1] * Tr * Tr * Y * (Y * S - Sma)
-            S_next = S - self.eta1S[i+1] / 10 * GS
+            with full_precision(X):
+                PX = fp(X / 255) / 4.0 * 255
+                GS = Y * (Y * S - PX)  + self.alphaS[i] * Tr * Tr * Y * (Y * S - Sma)
+                S_next = S - self.eta1S[i] / 10 * GS
             inputS = torch.cat((S_next, SZ), dim=1)
-            outS = self.proxNet_Sall[i+1](inputS)
-            S = outS[:, :1, :, :]
+            outS = self.proxNet_Sall[i](inputS)
+            S = outS[:, :1, :, :].float()
             SZ = outS[:, 1:, :, :]
-            ListS.append(S)
-            ListYS.append(Y * S)
 
             # updating X
-            ESX = PX - Y * S
-            GX = op_modpT((ESX / 255) * 4.0)
-            X_next = X - self.eta2S[i+1] / 10 * GX
+            with full_precision(X):
+                ESX = PX - Y * S
+                GX = pT((ESX / 255) * 4.0)
+                X_next = X - self.eta2S[i] / 10 * GX
             inputX = torch.cat((X_next, XZ), dim=1)
-            outX = self.proxNet_Xall[i+1](inputX)
-            X = outX[:, :1, :, :]
-            XZ = outX[:, 1:, :, :]
-            ListX.append(X)
-        return ListX, ListS, ListYS
+            if tiles is not None and i >= full_stages and not coarse:
+                X, XZ = tiles.apply(self.proxNet_Xall[i], inputX, X, XZ)
+            else:
+                outX = self.proxNet_Xall[i](inputX)
+                X = outX[:, :1, :, :].float()
+                XZ = outX[:, 1:, :, :]
+            outputs += [X, S]
+        return [XZ, SZ] + outputs
+
+    def run_adaptive(self, start, stop, X, XZ, S, SZ, Y, Sma, Tr, tol=None):
+        # stages start+1..stop, a sample whose X changed by less than tol (relative L2) leaves the batch,
+        # so the remaining stages only run on the samples that have not converged; returns the final X, XZ, S, SZ
+        # and the number of stages run by every sample
+        Xout, XZout, Sout, SZout = X.clone(), XZ.clone(), S.clone(), SZ.clone()
+        stages_used = torch.zeros(X.shape[0], dtype=torch.long, device=X.device)
+        active = torch.arange(X.shape[0], device=X.device)
+        for i in range(start, stop):
+            XZ, SZ, X_next, S = self.run_stages(i, i + 1, X, XZ, S, SZ, Y, Sma, Tr)
+            Xout[active], XZout[active], Sout[active], SZout[active] = X_next, XZ, S, SZ
+            stages_used[active] = i + 1 - start
+            if tol is not None:
+                change = (X_next - X).flatten(1).norm(dim=1) / X.flatten(1).norm(dim=1).clamp(min=1e-6)
+                go = change >= tol
+                if not go.all():
+                    active, X_next, XZ, S, SZ, Y, Sma, Tr = [t[go] for t in (active, X_next, XZ, S, SZ, Y, Sma, Tr)]
+                    if len(active) == 0:
+                        break
+            X = X_next
+        return Xout, XZout, Sout, SZout, stages_used
 
 # proxNet_S
 class Projnet(nn.Module):
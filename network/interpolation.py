@@ -0,0 +1,110 @@
+"""
+Linear interpolation (LI) of sinograms across the metal trace, vectorized over views, slices and batches.
+
+Every detector row of proj (..., nProj, nu) is linearly interpolated over the positions where
+metalTrace == 1 from the nearest non-metal bins on both sides, found for all rows at once with a
+running max/min of the non-metal indices instead of one interp1d per row. Metal runs touching the
+detector border take the value of the nearest non-metal bin, rows that are metal everywhere are
+left unchanged. The torch version runs on the device of its input, e.g. inside the model pipeline.
+
+python -m network.interpolation        # benchmark against the former per-view interp1d loop
+"""
+import time
+import numpy as np
+import torch
+
+
+def interpolate_projection(proj, metalTrace):
+    # numpy in -> numpy out (proj.dtype), tensor in -> tensor out
+    if torch.is_tensor(proj):
+        return interpolate_projection_torch(proj, metalTrace)
+    proj = np.asarray(proj)
+    out = proj.copy()
+    nu = proj.shape[-1]
+    metal = (np.asarray(metalTrace) == 1).reshape(-1, nu)
+    rows = np.flatnonzero(metal.any(axis=1))
+    if not len(rows):
+        return out
+    metal = metal[rows]
+    index = np.arange(nu, dtype=np.int32)
+    # nearest non-metal bin at or left of / at or right of every bin, -1 / nu if none
+    left = np.maximum.accumulate(np.where(metal, np.int32(-1), index), axis=1)
+    right = np.minimum.accumulate(np.where(metal, np.int32(nu), index)[:, ::-1], axis=1)[:, ::-1]
+    row, col = np.nonzero(metal)
+    left, right = left[row, col], right[row, col]
+    left_valid, right_valid = left >= 0, right < nu
+    keep = left_valid | right_valid
+    row, col = rows[row[keep]], col[keep]
+    left, right = np.where(left_valid, left, right)[keep], np.where(right_valid, right, left)[keep]
+    flat = out.reshape(-1, nu)
+    y_lo = flat[row, left].astype(np.float64)
+    y_hi = flat[row, right].astype(np.float64)
+    flat[row, col] = (y_hi - y_lo) / np.maximum(right - left, 1) * (col - left) + y_lo
+    return out
+
+
+def interpolate_projection_torch(proj, metalTrace):
+    metal = metalTrace == 1
+    nu = proj.shape[-1]
+    index = torch.arange(nu, device=proj.device).expand_as(proj)
+    left = torch.where(metal, torch.full_like(index, -1), index).cummax(-1)[0]
+    right = torch.where(metal, torch.full_like(index, nu), index).flip(-1).cummin(-1)[0].flip(-1)
+    left_valid, right_valid = left >= 0, right < nu
+    left, right = torch.where(left_valid, left, right).clamp(0, nu - 1), torch.where(right_valid, right, left).clamp(0, nu - 1)
+    y_lo = proj.gather(-1, left)
+    y_hi = proj.gather(-1, right)
+    span = (right - left).clamp(min=1).to(proj.dtype)
+    value = (y_hi - y_lo) / span * (index - left).to(proj.dtype) + y_lo
+    return torch.where(metal & (left_valid | right_valid), value, proj)
+
+
+def _legacy_interpolate_projection(proj, metalTrace):
+    from scipy.interpolate import interp1d
+    Pinterp = proj.copy()
+    for i in range(Pinterp.shape[0]):
+        mslice = metalTrace[i]
+        pslice = Pinterp[i]
+        metalpos = np.nonzero(mslice==1)[0]
+        nonmetalpos = np.nonzero(mslice==0)[0]
+        pnonmetal = pslice[nonmetalpos]
+        pslice[metalpos] = interp1d(nonmetalpos,pnonmetal)(metalpos)
+        Pinterp[i] = pslice
+    return Pinterp
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    N = 16
+    Sma = (rng.rand(N, 640, 641) * 4).astype(np.float32)
+    Tr = np.zeros_like(Sma)
+    views = np.arange(640)
+    for k in range(N):
+        # two sinusoidal metal traces, away from the detector border as interp1d requires
+        for center, amp, width in ((320, 150, 12), (300, 90, 6)):
+            u = (center + amp * np.sin(views * 2 * np.pi / 640 + k)).astype(int)
+            for w in range(-width, width + 1):
+                Tr[k, views, u + w] = 1
+    tic = time.time()
+    ref = np.stack([_legacy_interpolate_projection(Sma[k], Tr[k]) for k in range(N)])
+    print('interp1d loop      {:7.2f} slices/s'.format(N / (time.time() - tic)))
+    tic = time.time()
+    out = np.stack([interpolate_projection(Sma[k], Tr[k]) for k in range(N)])
+    print('numpy, per slice   {:7.2f} slices/s'.format(N / (time.time() - tic)))
+    tic = time.time()
+    out_volume = interpolate_projection(Sma, Tr)
+    print('numpy, volume      {:7.2f} slices/s'.format(N / (time.time() - tic)))
+    proj, trace = torch.from_numpy(Sma), torch.from_numpy(Tr)
+    interpolate_projection(proj[:1], trace[:1])
+    tic = time.time()
+    out_torch = interpolate_projection(proj, trace)
+    print('torch (cpu), volume {:6.2f} slices/s'.format(N / (time.time() - tic)))
+    if torch.cuda.is_available():
+        proj, trace = proj.cuda(), trace.cuda()
+        interpolate_projection(proj[:1], trace[:1])
+        torch.cuda.synchronize()
+        tic = time.time()
+        interpolate_projection(proj, trace)
+        torch.cuda.synchronize()
+        print('torch (cuda), volume {:5.2f} slices/s'.format(N / (time.time() - tic)))
+    print('max abs diff vs interp1d: numpy {:.2e}, volume {:.2e}, torch {:.2e}'.format(
+        np.abs(out - ref).max(), np.abs(out_volume - ref).max(), np.abs(out_torch.numpy() - ref).max()))
@@ -0,0 +1,342 @@
+"""
+Pure-PyTorch fan-beam projector/backprojector for the 640geo geometry of build_gemotry.py.
+
+The ray transform is discretised with Joseph's method and stored as a sparse CSR system matrix, so
+forward projection and its adjoint are one batched SpMM on CPU or GPU, without ODL/astra.
+Conventions (angles, detector axis, adjoint weighting) follow odl.tomo.RayTransform, so the
+operators are a drop-in replacement for odl_torch.OperatorModule(fp) / OperatorModule(fp.adjoint);
+parity_check measures the agreement with astra_cpu (python -m network.projector --check).
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from .build_gemotry import initialization, geometry_key
+
+# bump whenever the discretisation or the on-disk layout changes, old caches are then rebuilt
+CACHE_VERSION = 1
+# relative L2 error of forward projection and adjoint against odl astra_cpu allowed by parity_check
+PARITY_TOL = 0.02
+
+
+class FanBeamProjector(object):
+    def __init__(self, param, chunk=8):
+        self.param = dict(param)
+        self.nx, self.ny = param['nx_h'], param['ny_h']
+        self.nProj, self.nu = param['nProj'], param['nu_h']
+        self.dx = param['sx'] / self.nx
+        self.dy = param['sy'] / self.ny
+        self.dangle = (param['endangle'] - param['startangle']) / self.nProj
+        self.du = param['su'] / self.nu
+        self.chunk = chunk
+
+        # cell midpoints, as in odl.uniform_partition
+        self.angles = param['startangle'] + (np.arange(self.nProj) + 0.5) * self.dangle
+        self.det = -param['su'] / 2.0 + (np.arange(self.nu) + 0.5) * self.du
+
+        # a square grid and a full circle of views divisible by 4 are invariant under rotations by
+        # 90 degrees, so only the first quarter of the views has to be stored
+        full_circle = np.isclose(param['endangle'] - param['startangle'], 2 * np.pi)
+        square = self.nx == self.ny and np.isclose(self.dx, self.dy)
+        self.nsym = 4 if full_circle and square and self.nProj % 4 == 0 else 1
+        self.nbase = self.nProj // self.nsym
+
+        # odl weights the inner products by the cell volumes, so its adjoint is scale * A^T
+        self.scale = self.dangle * self.du / (self.dx * self.dy)
+        self.matrix = None
+        self.matrix_t = None
+        self._operands = {}
+
+    def __deepcopy__(self, memo):
+        # the system matrix is immutable and shared by every model holding this projector
+        return self
+
+    def _joseph(self, views):
+        """(row, col, weight) entries of the system matrix for the given views."""
+        p = self.param
+        theta = torch.from_numpy(self.angles[views])[:, None]
+        det = torch.from_numpy(self.det)[None, :]
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        src_x, src_y = p['dso'] * sin, -p['dso'] * cos
+        rx = -p['dde'] * sin + det * cos - src_x
+        ry = p['dde'] * cos + det * sin - src_y
+        length = torch.sqrt(rx ** 2 + ry ** 2)
+        xdom = rx.abs() >= ry.abs()
+        rows = torch.from_numpy(views)[:, None] * self.nu + torch.arange(self.nu)[None, :]
+
+        entries = []
+        for dominant in (True, False):
+            sel = xdom if dominant else ~xdom
+            if dominant:
+                # step along x through every pixel column, interpolate linearly in y
+                n, n_other = self.nx, self.ny
+                pos = -p['sx'] / 2.0 + (torch.arange(n, dtype=torch.float64) + 0.5) * self.dx
+                t = (pos[None, :] - src_x.expand_as(sel)[sel][:, None]) / rx[sel][:, None]
+                frac = (src_y.expand_as(sel)[sel][:, None] + t * ry[sel][:, None] + p['sy'] / 2.0) / self.dy - 0.5
+                step = self.dx * length[sel] / rx[sel].abs()
+            else:
+                n, n_other = self.ny, self.nx
+                pos = -p['sy'] / 2.0 + (torch.arange(n, dtype=torch.float64) + 0.5) * self.dy
+                t = (pos[None, :] - src_y.expand_as(sel)[sel][:, None]) / ry[sel][:, None]
+                frac = (src_x.expand_as(sel)[sel][:, None] + t * rx[sel][:, None] + p['sx'] / 2.0) / self.dx - 0.5
+                step = self.dy * length[sel] / ry[sel].abs()
+            lower = torch.floor(frac)
+            w_upper = frac - lower
+            lower = lower.long()
+            other = torch.stack((lower, lower + 1), dim=-1)
+            weight = torch.stack((1 - w_upper, w_upper), dim=-1) * step[:, None, None]
+            k = torch.arange(n)[None, :, None].expand_as(other)
+            col = k * self.ny + other if dominant else other * self.ny + k
+            row = rows[sel][:, None, None].expand_as(other)
+            valid = (other >= 0) & (other < n_other)
+            entries.append((row[valid], col[valid], weight[valid]))
+        row = torch.cat([e[0] for e in entries])
+        col = torch.cat([e[1] for e in entries])
+        weight = torch.cat([e[2] for e in entries])
+        order = torch.argsort(row * (self.nx * self.ny) + col)
+        return row[order], col[order], weight[order]
+
+    def build(self):
+        """Assemble the CSR system matrix of the first nProj / nsym views."""
+        counts = torch.zeros(self.nbase * self.nu, dtype=torch.int64)
+        cols, weights = [], []
+        for start in range(0, self.nbase, self.chunk):
+            views = np.arange(start, min(start + self.chunk, self.nbase))
+            row, col, weight = self._joseph(views)
+            counts += torch.bincount(row, minlength=counts.numel())
+            cols.append(col.int())
+            weights.append(weight.float())
+        crow = torch.zeros(counts.numel() + 1, dtype=torch.int32)
+        crow[1:] = torch.cumsum(counts, 0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # sparse CSR support is flagged as beta
+            self.matrix = torch.sparse_csr_tensor(crow, torch.cat(cols), torch.cat(weights),
+                                                  size=(self.nbase * self.nu, self.nx * self.ny))
+        return self.matrix
+
+    def save(self, path):
+        """Write the geometry (param, angles, detector grid) and the system matrix to directory path.
+
+        The directory is written under a temporary name and renamed, so concurrent workers never
+        see a partial cache.
+        """
+        if self.matrix is None:
+            self.build()
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(tmp):
+                os.makedirs(tmp)
+            np.save(os.path.join(tmp, 'angles.npy'), self.angles)
+            np.save(os.path.join(tmp, 'det.npy'), self.det)
+            for prefix, matrix in (('', self.matrix), ('t', self.transpose())):
+                np.save(os.path.join(tmp, prefix + 'crow.npy'), matrix.crow_indices().numpy())
+                np.save(os.path.join(tmp, prefix + 'col.npy'), matrix.col_indices().numpy())
+                np.save(os.path.join(tmp, prefix + 'val.npy'), matrix.values().numpy())
+            manifest = {'version': CACHE_VERSION, 'key': geometry_key(self.param), 'nsym': self.nsym,
+                        'nnz': int(self.matrix.values().numel()),
+                        'param': {k: v if isinstance(v, int) else float(v) for k, v in self.param.items()}}
+            with open(os.path.join(tmp, 'geometry.json'), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                pass  # another process finished first
+        finally:
+            # the partial or superseded directory of an interrupted, failed or lost write
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a cache written by save(); with mmap the arrays are memory-mapped, not read."""
+        with open(os.path.join(path, 'geometry.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != CACHE_VERSION:
+            raise ValueError('{} has cache version {}, expected {}'.format(path, manifest['version'], CACHE_VERSION))
+        projector = cls(manifest['param'])
+        mmap_mode = 'r' if mmap else None
+        projector.angles = np.load(os.path.join(path, 'angles.npy'))
+        projector.det = np.load(os.path.join(path, 'det.npy'))
+        shape = (projector.nbase * projector.nu, projector.nx * projector.ny)
+        for prefix in ('', 't'):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # read-only memmaps, beta sparse CSR support
+                crow, col, val = [torch.from_numpy(np.load(os.path.join(path, prefix + name + '.npy'), mmap_mode=mmap_mode))
+                                  for name in ('crow', 'col', 'val')]
+                matrix = torch.sparse_csr_tensor(crow, col, val, size=shape if prefix == '' else shape[::-1])
+            setattr(projector, 'matrix' if prefix == '' else 'matrix_t', matrix)
+        return projector
+
+    @classmethod
+    def cached(cls, param, cache_dir, mmap=True):
+        """Projector for param from cache_dir, building and storing the system matrix on a miss."""
+        path = cache_path(cache_dir, param)
+        if os.path.isfile(os.path.join(path, 'geometry.json')):
+            try:
+                return cls.load(path, mmap)
+            except ValueError:
+                shutil.rmtree(path)
+        projector = cls(param)
+        projector.save(path)
+        return cls.load(path, mmap) if mmap else projector
+
+    def to_scipy(self, transpose=False):
+        """The system matrix (first nProj / nsym views) as scipy.sparse.csr_matrix, sharing memory."""
+        import scipy.sparse
+        matrix = self.transpose() if transpose else (self.matrix if self.matrix is not None else self.build())
+        return scipy.sparse.csr_matrix((matrix.values().numpy(), matrix.col_indices().numpy(),
+                                        matrix.crow_indices().numpy()), shape=tuple(matrix.shape))
+
+    def transpose(self):
+        """A^T as CSR (csr @ dense is much faster than the csc view returned by A.t())."""
+        if self.matrix_t is None:
+            if self.matrix is None:
+                self.build()
+            At = self.matrix.to_sparse_csc()
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.matrix_t = torch.sparse_csr_tensor(At.ccol_indices(), At.row_indices(), At.values(),
+                                                        size=(self.nx * self.ny, self.nbase * self.nu))
+        return self.matrix_t
+
+    def operands(self, device, transpose=False):
+        """System matrix, or its transpose, on the given device."""
+        key = (torch.device(device), transpose)
+        if key not in self._operands:
+            if transpose:
+                self._operands[key] = self.transpose().to(device)
+            else:
+                self._operands[key] = (self.matrix if self.matrix is not None else self.build()).to(device)
+        return self._operands[key]
+
+    def apply(self, x):
+        """A x for x of shape (..., nx, ny), returning (..., nProj, nu). No autograd."""
+        return project(self.operands(x.device), x, self.nsym, self.nbase, self.nu)
+
+    def apply_transpose(self, y):
+        """A^T y for y of shape (..., nProj, nu), returning (..., nx, ny). No autograd."""
+        return project_transpose(self.operands(y.device, transpose=True), y, self.nsym, self.nx, self.ny)
+
+    def forward(self, x):
+        if isinstance(x, np.ndarray):
+            with torch.no_grad():
+                return self.forward(torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))).numpy()
+        return _RayTransform.apply(x, self)
+
+    def adjoint(self, y):
+        if isinstance(y, np.ndarray):
+            with torch.no_grad():
+                return self.adjoint(torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32))).numpy()
+        return _RayTransformAdjoint.apply(y, self)
+
+    __call__ = forward
+
+
+def project(A, x, nsym, nbase, nu):
+    # A x for the stored first nbase views, the others by rotating x in steps of 90 degrees
+    lead = x.shape[:-2]
+    nx, ny = x.shape[-2], x.shape[-1]
+    x = x.reshape(-1, nx, ny).to(A.dtype)
+    B = x.shape[0]
+    xs = torch.stack([torch.rot90(x, -m, dims=(1, 2)) for m in range(nsym)], dim=0)
+    y = torch.mm(A, xs.reshape(nsym * B, -1).t()).t()
+    y = y.reshape(nsym, B, nbase, nu).transpose(0, 1)
+    return y.reshape(lead + (nsym * nbase, nu))
+
+
+def project_transpose(AT, y, nsym, nx, ny):
+    lead = y.shape[:-2]
+    y = y.reshape(-1, nsym, AT.shape[1]).to(AT.dtype)
+    B = y.shape[0]
+    x = torch.mm(AT, y.transpose(0, 1).reshape(nsym * B, -1).t()).t()
+    x = x.reshape(nsym, B, nx, ny)
+    x = sum(torch.rot90(x[m], m, dims=(1, 2)) for m in range(nsym))
+    return x.reshape(lead + (nx, ny))
+
+
+def parity_check(projector, impl='astra_cpu', tol=PARITY_TOL):
+    """Relative L2 errors (forward, adjoint) of projector against odl.tomo.RayTransform(impl) on a
+    Shepp-Logan phantom and its sinogram; raises AssertionError above tol, returns None without ODL/astra."""
+    try:
+        import odl
+    except ImportError:
+        return None
+    if not odl.tomo.ASTRA_AVAILABLE:
+        return None
+    from .build_gemotry import get_operators
+    ray_trafo = get_operators(projector.param, 'odl', impl).ray_trafo
+    phantom = np.asarray(odl.phantom.shepp_logan(ray_trafo.domain, modified=True), dtype=np.float32)
+    sinogram = np.asarray(ray_trafo(phantom), dtype=np.float32)
+    backprojection = np.asarray(ray_trafo.adjoint(sinogram), dtype=np.float32)
+    errors = []
+    for ours, reference in ((projector.forward(phantom), sinogram), (projector.adjoint(sinogram), backprojection)):
+        errors.append(float(np.linalg.norm(ours - reference) / np.linalg.norm(reference)))
+    assert max(errors) <= tol, 'torch projector differs from odl {}: forward {:.2%}, adjoint {:.2%} (tolerance {:.2%})'.format(
+        impl, errors[0], errors[1], tol)
+    return tuple(errors)
+
+
+def cache_path(cache_dir, param):
+    return os.path.join(cache_dir, 'fanbeam_v{}_{}'.format(CACHE_VERSION, geometry_key(param)))
+
+
+class _RayTransform(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, projector):
+        ctx.projector, ctx.dtype = projector, x.dtype
+        return projector.apply(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return ctx.projector.apply_transpose(grad).to(ctx.dtype), None
+
+
+class _RayTransformAdjoint(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, y, projector):
+        ctx.projector, ctx.dtype = projector, y.dtype
+        return projector.apply_transpose(y) * projector.scale
+
+    @staticmethod
+    def backward(ctx, grad):
+        return (ctx.projector.apply(grad) * ctx.projector.scale).to(ctx.dtype), None
+
+
+class ProjectorModule(nn.Module):
+    """Batched (B, 1, H, W) wrapper of a FanBeamProjector, like odl_torch.OperatorModule."""
+    def __init__(self, projector, adjoint=False):
+        super(ProjectorModule, self).__init__()
+        self.projector = projector
+        self.is_adjoint = adjoint
+
+    def forward(self, input):
+        if self.is_adjoint:
+            return self.projector.adjoint(input)
+        return self.projector.forward(input)
+
+
+if __name__ == '__main__':
+    # python -m network.projector --cache_dir geometry_cache/ [--check]
+    parser = argparse.ArgumentParser(description='Precompute the sparse system matrix of the 640geo fan-beam geometry')
+    parser.add_argument('--cache_dir', type=str, default=os.environ.get('INDUDONET_GEOMETRY_CACHE', 'geometry_cache/'),
+                        help='directory of the versioned geometry cache')
+    parser.add_argument('--check', action='store_true', help='compare forward and adjoint against odl astra_cpu (skipped without astra)')
+    parser.add_argument('--tol', type=float, default=PARITY_TOL, help='relative L2 tolerance of --check')
+    opt = parser.parse_args()
+    param = initialization().param
+    path = cache_path(opt.cache_dir, param)
+    tic = time.time()
+    projector = FanBeamProjector.cached(param, opt.cache_dir)
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    print('{}: nnz={:d} ({:d}-fold symmetry), {:.1f} MB, {:.2f}s'.format(
+        path, projector.matrix.values().numel(), projector.nsym, size / 2 ** 20, time.time() - tic))
+    if opt.check:
+        errors = parity_check(projector, tol=opt.tol)
+        if errors is None:
+            print('parity check skipped: ODL / astra not available')
+        else:
+            print('parity with odl astra_cpu: forward {:.2%}, adjoint {:.2%} (tolerance {:.2%})'.format(errors[0], errors[1], opt.tol))
@@ -0,0 +1,110 @@
+"""
+Post-training static int8 quantization of the ProxNets (CTnet, Projnet) and the UNet priornet for CPU inference.
+
+Every ProxNet is traced with torch.fx, its Conv -> BN -> ReLU blocks fused, observed while a few
+calibration samples run through the whole network and converted to int8 kernels (x86 / fbgemm or
+qnnpack). The ProxNets take and return float tensors, so the data-consistency updates (projections,
+GS, GX, eta1S, eta2S, alphaS) stay in float.
+
+python -m network.quantize --model_dir pretrained_model/InDuDoNet_latest.pt --data_path deeplesion/test/ --projector torch
+"""
+import os
+import copy
+import time
+import argparse
+import warnings
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def proxnet_slots(net):
+    """(parent module, attribute name) of every ProxNet and of the priornet."""
+    slots = [(net, 'priornet'), (net, 'proxNet_X0'), (net, 'proxNet_S0')]
+    for stages in (net.proxNet_Xall, net.proxNet_Sall):
+        slots += [(stages, str(i)) for i in range(len(stages))]
+    return slots
+
+
+def prepare_proxnets(net, backend='x86'):
+    # replaces every ProxNet by its observed (calibration) version
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    net.eval()
+    for parent, name in proxnet_slots(net):
+        module = getattr(parent, name)
+        channels = module.channels if hasattr(module, 'channels') else module.inc.conv.conv[0].in_channels
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # deprecation notes of the fx quantization API
+            setattr(parent, name, prepare_fx(module, qconfig_mapping, (torch.rand(1, channels, 32, 32),)))
+    return net
+
+
+def convert_proxnets(net):
+    for parent, name in proxnet_slots(net):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            setattr(parent, name, convert_fx(getattr(parent, name)))
+    return net
+
+
+def quantize_proxnets(net, calibration, backend='x86'):
+    """Quantize the ProxNets of net in place, calibrating on an iterable of (Xma, XLI, M, Sma, SLI, Tr) batches."""
+    prepare_proxnets(net, backend)
+    with torch.no_grad():
+        for inputs in calibration:
+            net(*inputs, stages=(-1,))
+    return convert_proxnets(net)
+
+
+if __name__ == '__main__':
+    from deeplesion import MARTestDataset
+    from deeplesion.metrics import psnr, ssim
+    from .indudonet import InDuDoNet
+    from .build_gemotry import select_astra_gpu
+    parser = argparse.ArgumentParser(description='Static int8 quantization of the ProxNets with accuracy and speed report')
+    parser.add_argument('--model_dir', type=str, default=None, help='checkpoint (default: random weights)')
+    parser.add_argument('--data_path', type=str, default='deeplesion/test/', help='DeepLesion test data')
+    parser.add_argument('--calibration', type=int, default=4, help='number of calibration samples')
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'])
+    parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
+    parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
+    parser.add_argument('--S', type=int, default=10, help='the number of total iterative stages')
+    parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
+    parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
+    parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+    parser.add_argument('--projector', type=str, default='torch', choices=['odl', 'torch'])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='astra device of --projector odl (astra_cuda or astra_cpu); the int8 ProxNets always run on CPU')
+    opt = parser.parse_args()
+    select_astra_gpu(torch.device(opt.device))
+    net = InDuDoNet(opt)
+    if opt.model_dir is not None:
+        net.load_state_dict(torch.load(os.path.join(opt.model_dir), map_location='cpu'))
+    net.eval()
+    impl = 'astra_cpu' if opt.device.startswith('cpu') else 'astra_cuda'
+    dataset = MARTestDataset(opt.data_path, np.load(os.path.join(opt.data_path, 'testmask.npy')), opt.projector, impl=impl)
+    samples = [[x.unsqueeze(0) for x in dataset[i]] for i in range(len(dataset))]
+
+    def evaluate(model):
+        # mean PSNR / SSIM in the display window of test_deeplesion.py and s/slice
+        scores, seconds = [], 0
+        with torch.no_grad():
+            for Xma, XLI, Xgt, M, Sma, SLI, Sgt, Tr in samples:
+                tic = time.time()
+                X = model(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,))[0][-1]
+                seconds += time.time() - tic
+                X, Xgt = [torch.clamp(x / 255.0, 0, 0.5) / 0.5 for x in (X, Xgt)]
+                scores.append((psnr(X, Xgt, M).item(), ssim(X, Xgt, M).item()))
+        return np.mean(scores, axis=0), seconds / len(samples)
+
+    (psnr_fp32, ssim_fp32), t_fp32 = evaluate(net)
+    tic = time.time()
+    calibration = [(Xma, XLI, M, Sma, SLI, Tr) for Xma, XLI, Xgt, M, Sma, SLI, Sgt, Tr in samples[:opt.calibration]]
+    quantized = quantize_proxnets(copy.deepcopy(net), calibration, opt.backend)
+    print('calibrated on {:d} samples in {:.2f}s'.format(len(calibration), time.time() - tic))
+    (psnr_int8, ssim_int8), t_int8 = evaluate(quantized)
+    print('fp32: PSNR={:.3f} SSIM={:.4f} {:.3f} s/slice'.format(psnr_fp32, ssim_fp32, t_fp32))
+    print('int8: PSNR={:.3f} SSIM={:.4f} {:.3f} s/slice'.format(psnr_int8, ssim_int8, t_int8))
+    print('dPSNR={:+.3f} dSSIM={:+.4f} speedup x{:.2f} ({:d} samples)'.format(
+        psnr_int8 - psnr_fp32, ssim_int8 - ssim_fp32, t_fp32 / t_int8, len(samples)))
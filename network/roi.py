@@ -0,0 +1,125 @@
+"""
+Metal-ROI restricted image-domain refinement for inference.
+
+Metal artifacts are local, so after the first full_stages stages with full-image updates the CTnet of
+every later stage only runs on the tiles of the 416x416 image that overlap the metal mask M dilated by margin
+pixels. Each tile is cut out with a halo of 2T pixels (the receptive field of the 2T 3x3 convolutions of
+CTnet), so the refined pixels equal those of the full-image CTnet; outside the tiles X and its auxiliary
+channels keep the values of the previous stage. The sinogram-domain updates and the projections stay
+full size.
+
+python -m network.roi --S 10 --full_stages 4        # CTnet FLOPs, latency and PSNR/SSIM of ROI against full refinement
+"""
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class TileROI(object):
+    """Inference option of InDuDoNet.forward(roi=...): full stages 1..full_stages, tiled CTnet afterwards."""
+    def __init__(self, full_stages, tile=52, margin=16):
+        self.full_stages = full_stages
+        self.tile = tile
+        self.margin = margin
+
+    def tiles(self, M, halo):
+        return Tiles(M, self.tile, self.margin, halo)
+
+
+class Tiles(object):
+    """The tiles of a batch of metal masks M (B, 1, H, W), cut and stitched back by apply."""
+    def __init__(self, M, tile, margin, halo):
+        B, _, H, W = M.shape
+        self.tile = min(tile, H, W)
+        self.crop = min(self.tile + 2 * halo, H, W)
+        dilated = F.max_pool2d((M > 0).float(), 2 * margin + 1, stride=1, padding=margin)
+        # grid cell (k, l) covers rows k*tile.. and columns l*tile.. of the image
+        grid = F.max_pool2d(dilated, self.tile, stride=self.tile, ceil_mode=True)
+        self.index = []
+        for b, k, l in grid[:, 0].nonzero().tolist():
+            y, x = min(k * self.tile, H - self.tile), min(l * self.tile, W - self.tile)
+            # crop windows are shifted to stay inside the image, so they all have the same size and the
+            # zero padding at the image border is the one of the full-image CTnet
+            cy = min(max(y - halo, 0), H - self.crop)
+            cx = min(max(x - halo, 0), W - self.crop)
+            self.index.append((b, y, x, cy, cx))
+        self.fraction = len(self.index) * self.crop ** 2 / float(B * H * W)   # CTnet pixels relative to full
+
+    def apply(self, proxnet, input, X, XZ):
+        # (X, XZ) of proxnet(input) on the tiles, the given X, XZ elsewhere
+        if not self.index:
+            return X, XZ
+        c, t = self.crop, self.tile
+        out = proxnet(torch.stack([input[b, :, cy:cy + c, cx:cx + c] for b, y, x, cy, cx in self.index]))
+        X, XZ = X.clone(), XZ.clone()
+        for n, (b, y, x, cy, cx) in enumerate(self.index):
+            refined = out[n, :, y - cy:y - cy + t, x - cx:x - cx + t]
+            X[b, :, y:y + t, x:x + t] = refined[:1]
+            XZ[b, :, y:y + t, x:x + t] = refined[1:]
+        return X, XZ
+
+
+if __name__ == '__main__':
+    from deeplesion import MARTestDataset
+    from deeplesion.metrics import psnr, ssim
+    from .indudonet import InDuDoNet
+    from .build_gemotry import select_astra_gpu
+    parser = argparse.ArgumentParser(description='FLOPs, latency and accuracy of the metal-ROI CTnet refinement')
+    parser.add_argument('--model_dir', type=str, default=None, help='checkpoint (default: random weights)')
+    parser.add_argument('--data_path', type=str, default='deeplesion/test/', help='DeepLesion test data')
+    parser.add_argument('--full_stages', type=int, default=4, help='stages with full-image CTnet')
+    parser.add_argument('--tile', type=int, default=52, help='tile size in pixels')
+    parser.add_argument('--margin', type=int, default=16, help='dilation of the metal mask in pixels')
+    parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
+    parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
+    parser.add_argument('--S', type=int, default=10, help='the number of total iterative stages')
+    parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
+    parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
+    parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+    parser.add_argument('--projector', type=str, default='torch', choices=['odl', 'torch'])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model and the tensors, e.g. cuda, cuda:1 or cpu')
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+    select_astra_gpu(device)
+    net = InDuDoNet(opt).to(device)
+    if opt.model_dir is not None:
+        net.load_state_dict(torch.load(opt.model_dir, map_location=device))
+    net.eval()
+    roi = TileROI(opt.full_stages, opt.tile, opt.margin)
+    impl = 'astra_cuda' if device.type == 'cuda' else 'astra_cpu'
+    dataset = MARTestDataset(opt.data_path, np.load(opt.data_path + '/testmask.npy'), opt.projector, impl=impl)
+    # CTnet multiply-adds per pixel: 2T 3x3 convolutions with num_channel + 1 channels
+    ctnet_macs = 2 * opt.T * 9 * (opt.num_channel + 1) ** 2
+    full_time, roi_time, fractions, scores = 0, 0, [], []
+    with torch.no_grad():
+        for i in range(len(dataset)):
+            Xma, XLI, Xgt, M, Sma, SLI, Sgt, Tr = [x.unsqueeze(0).to(device) for x in dataset[i]]
+            tic = time.time()
+            Xfull = net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,))[0][-1]
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            full_time += time.time() - tic
+            tic = time.time()
+            Xroi = net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,), roi=roi)[0][-1]
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            roi_time += time.time() - tic
+            fractions.append(roi.tiles(M, 2 * opt.T).fraction)
+            Xgt, Xfull, Xroi = [torch.clamp(x / 255.0, 0, 0.5) / 0.5 for x in (Xgt, Xfull, Xroi)]
+            scores.append((psnr(Xfull, Xgt, M).item(), psnr(Xroi, Xgt, M).item(), ssim(Xfull, Xgt, M).item(),
+                           ssim(Xroi, Xgt, M).item(), psnr(Xroi, Xfull, M).item()))
+    fraction = np.mean(fractions)
+    roi_stages = opt.S - min(opt.full_stages, opt.S)
+    # CTnet work of the S stages (the initialization proxNet_X0 always runs on the full image)
+    saved = roi_stages * (1 - fraction) / (opt.S + 1)
+    psnr_full, psnr_roi, ssim_full, ssim_roi, psnr_agree = np.mean(scores, axis=0)
+    print('{:d} samples, tiled CTnet on {:.1f}% of the pixels in {:d} of {:d} stages'.format(
+        len(dataset), 100 * fraction, roi_stages, opt.S))
+    print('image-domain ProxNet: {:.2f} GMAC/slice saved ({:.1f}%)'.format(
+        saved * (opt.S + 1) * ctnet_macs * 416 * 416 / 1e9, 100 * saved))
+    print('full {:.3f} s/slice, ROI {:.3f} s/slice ({:.1f}% less)'.format(
+        full_time / len(dataset), roi_time / len(dataset), 100 * (1 - roi_time / full_time)))
+    print('full PSNR={:.3f} SSIM={:.4f}; ROI PSNR={:.3f} SSIM={:.4f}; PSNR ROI vs full {:.2f} dB'.format(
+        psnr_full, ssim_full, psnr_roi, ssim_roi, psnr_agree))
@@ -4,16 +4,22 @@ import os.path
 import argparse
 import numpy as np
 import torch
-from CLINIC_metal.preprocess_clinic.preprocessing_clinic import clinic_input_data
-from network.indudonet import InDuDoNet
+from CLINIC_metal.preprocess_clinic.preprocessing_clinic import clinic_volumes
+from network.indudonet import InDuDoNet, autocast
+from network.fuse import fold_batchnorm
+from network.roi import TileROI
+from network.build_gemotry import select_astra_gpu
+from deeplesion.preprocess import prepare
+from deeplesion.metrics import psnr, ssim
 import nibabel
 import time
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 parser = argparse.ArgumentParser(description="YU_Test")
 parser.add_argument("--model_dir", type=str, default="models", help='path to model and log files')
 parser.add_argument("--data_path", type=str, default="CLINIC_metal/test/", help='path to training data')
-parser.add_argument("--use_GPU", type=bool, default=True, help='use GPU or not')
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model and the tensors, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--num_threads', type=int, default=0, help='intra-op CPU threads (0: PyTorch default)')
+parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op CPU threads (0: PyTorch default)')
 parser.add_argument("--save_path", type=str, default="results/CLINIC_metal/", help='path to training data')
 parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
 parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
@@ -21,7 +27,35 @@ parser.add_argument('--S', type=int, default=10, help='the number of total itera
 parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
 parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
 parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+parser.add_argument('--batch_size', type=int, default=1, help='number of slices per forward pass')
+parser.add_argument('--preprocess_workers', type=int, default=0, help='processes preprocessing the next volume during inference (0: serial)')
+parser.add_argument('--preprocess_dir', type=str, default=None, help='keep the preprocessed volumes as .npy in this folder (default: temporary)')
+parser.add_argument('--preprocess_cache', type=str, default=None, help='folder of the on-disk cache of preprocessed volumes (default: no cache)')
+parser.add_argument('--preprocess_cache_size', type=float, default=50, help='size bound of the preprocessing cache in GB')
+parser.add_argument('--fold_bn', action='store_true', help='fold the BatchNorm layers into the convolutions (inference only)')
+parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='mixed precision inference of the ProxNets and the PriorNet')
+parser.add_argument('--max_stages', type=int, default=None, help='early exit: run at most this many stages')
+parser.add_argument('--exit_tol', type=float, default=None, help='early exit: stop a slice when the relative change of X between stages is below this')
+parser.add_argument('--warm_start', type=int, default=0, help='initialize every slice from the final state of the previous one and run only this many last stages (0: off, needs --batch_size 1)')
+parser.add_argument('--warm_prior', action='store_true', help='with --warm_start also reuse the prior sinogram of the previous slices instead of running the PriorNet')
+parser.add_argument('--warm_check', action='store_true', help='also run all stages from scratch and report the throughput and the PSNR/SSIM of --warm_start against it')
+parser.add_argument('--roi_full_stages', type=int, default=None, help='metal-ROI refinement: full-image CTnet only in the first stages, then on the tiles around the metal (see network/roi.py)')
+parser.add_argument('--roi_tile', type=int, default=52, help='tile size of the metal-ROI refinement')
+parser.add_argument('--roi_margin', type=int, default=16, help='dilation of the metal mask (pixels) of the metal-ROI refinement')
+parser.add_argument('--coarse_stages', type=int, default=0, help='coarse-to-fine: initialization and the first stages on the geometry downsampled by --coarse_factor (must match training)')
+parser.add_argument('--coarse_factor', type=int, default=2, help='downsampling of the coarse geometry (e.g. 2: 208x208 images, 320 views)')
+parser.add_argument('--projector', type=str, default='odl', choices=['odl', 'torch'], help='fan-beam projector backend: odl (astra_cuda, astra_cpu with --device cpu) or torch (native sparse)')
 opt = parser.parse_args()
+if opt.warm_start and opt.batch_size > 1:
+    parser.error('--warm_start chains consecutive slices and needs --batch_size 1')
+if opt.roi_full_stages is not None and (opt.max_stages is not None or opt.exit_tol is not None or opt.warm_start):
+    parser.error('--roi_full_stages cannot be combined with --max_stages, --exit_tol or --warm_start')
+if opt.coarse_stages > 0 and (opt.max_stages is not None or opt.exit_tol is not None or opt.warm_start):
+    parser.error('--coarse_stages cannot be combined with --max_stages, --exit_tol or --warm_start')
+if opt.num_threads > 0:
+    torch.set_num_threads(opt.num_threads)
+if opt.num_interop_threads > 0:
+    torch.set_num_interop_threads(opt.num_interop_threads)
 def mkdir(path):
     folder = os.path.exists(path)
     if not folder:
@@ -33,62 +67,100 @@ def mkdir(path):
 Pred_nii = opt.save_path +'/X_mar/'
 mkdir(Pred_nii)
 
-def image_get_minmax():
-    return 0.0, 1.0
-def proj_get_minmax():
-    return 0.0, 4.0
+def test_image(volume, start, stop, pin_memory=False):
+    # slices start:stop of a volume (Xma, XLI, M, Sma, SLI, Tr) as n*1*h*w host tensors
+    Xma, XLI, M, Sma, SLI, Tr = [np.moveaxis(a[..., start:stop], -1, 0) for a in volume]
+    Xma, XLI, Sma, SLI, Tr, Mask = prepare((Xma, XLI), (Sma, SLI), (Tr,), (M,), pin_memory=pin_memory)
+    return Xma, XLI, Mask, Sma, SLI, Tr
 
-def normalize(data, minmax):
-    data_min, data_max = minmax
-    data = np.clip(data, data_min, data_max) 
-    data = (data - data_min) / (data_max - data_min)
-    data = data * 255.0
-    data = data.astype(np.float32)
-    data = np.expand_dims(np.transpose(np.expand_dims(data, 2), (2, 0, 1)),0)
-    return data
-
-def test_image(allXma, allXLI, allM, allSma, allSLI, allTr, vol_idx, slice_idx):
-    Xma = allXma[vol_idx][...,slice_idx]
-    XLI = allXLI[vol_idx][...,slice_idx]
-    M = allM[vol_idx][...,slice_idx]
-    Sma = allSma[vol_idx][...,slice_idx]
-    SLI = allSLI[vol_idx][...,slice_idx]
-    Tr = allTr[vol_idx][...,slice_idx]
-    Xma = normalize(Xma, image_get_minmax())  # *255
-    XLI = normalize(XLI, image_get_minmax())
-    Sma = normalize(Sma, proj_get_minmax())
-    SLI = normalize(SLI, proj_get_minmax())
-    Tr = 1-Tr.astype(np.float32)
-    Tr = np.expand_dims(np.transpose(np.expand_dims(Tr, 2), (2, 0, 1)),0) # 1*1*h*w
-    Mask = M.astype(np.float32)
-    Mask = np.expand_dims(np.transpose(np.expand_dims(Mask, 2), (2, 0, 1)),0)
-    return torch.Tensor(Xma).cuda(), torch.Tensor(XLI).cuda(), torch.Tensor(Mask).cuda(), \
-       torch.Tensor(Sma).cuda(), torch.Tensor(SLI).cuda(), torch.Tensor(Tr).cuda()
+def volume_batches(volume, batch_size, device):
+    # yields (start, inputs on device); the next batch is normalized on the host and copied to the GPU
+    # on a side stream while the current one is in the network
+    num_s = volume[0].shape[2]
+    cuda = device.type == 'cuda'
+    stream = torch.cuda.Stream() if cuda else None
+    def load(start):
+        batch = test_image(volume, start, min(start + batch_size, num_s), pin_memory=cuda)
+        if not cuda:
+            return batch
+        with torch.cuda.stream(stream):
+            return [x.to(device, non_blocking=True) for x in batch]
+    next_batch = load(0)
+    for start in range(0, num_s, batch_size):
+        batch = next_batch
+        if cuda:
+            torch.cuda.current_stream().wait_stream(stream)
+            for x in batch:
+                x.record_stream(torch.cuda.current_stream())
+        if start + batch_size < num_s:
+            next_batch = load(start + batch_size)
+        yield start, batch
 
 def main():
     # Build model
     print('Loading model ...\n')
-    net = InDuDoNet(opt).cuda()
-    net.load_state_dict(torch.load(os.path.join(opt.model_dir)))
+    device = torch.device(opt.device)
+    select_astra_gpu(device)
+    net = InDuDoNet(opt).to(device)
+    net.load_state_dict(torch.load(os.path.join(opt.model_dir), map_location=device))
     net.eval()
-    print('--------------load---------------all----------------nii-------------')
-    allXma, allXLI, allM, allSma, allSLI, allTr, allaffine, allfilename = clinic_input_data(opt.data_path)
+    if opt.fold_bn:
+        fold_batchnorm(net)
     print('--------------test---------------all----------------nii-------------')
-    for vol_idx in range(len(allXma)):
+    roi = TileROI(opt.roi_full_stages, opt.roi_tile, opt.roi_margin) if opt.roi_full_stages is not None else None
+    adaptive = opt.max_stages is not None or opt.exit_tol is not None or opt.warm_start   # early exit or warm start
+    # volumes are preprocessed one at a time: preprocess -> infer -> save
+    for vol_idx, (pre_name, affine, *volume) in enumerate(clinic_volumes(opt.data_path, opt.preprocess_workers,
+                                                                                 opt.preprocess_dir,
+                                                                                 impl='astra_cuda' if device.type == 'cuda' else 'astra_cpu',
+                                                                                 cache_dir=opt.preprocess_cache,
+                                                                                 cache_size=int(opt.preprocess_cache_size * 2 ** 30))):
         print('test %d th volume.......' % vol_idx)
-        num_s = allXma[vol_idx].shape[2]
-        pre_Xout = np.zeros_like(allXma[vol_idx])
-        pre_name = allfilename[vol_idx]
-        for slice_idx in range(num_s):
-            Xma, XLI, M, Sma, SLI, Tr  = test_image(allXma, allXLI, allM, allSma, allSLI, allTr, vol_idx, slice_idx)
-            with torch.no_grad():
-                if opt.use_GPU:
+        num_s = volume[0].shape[2]
+        # preallocated (pinned) output volume, filled asynchronously and synchronized once per volume
+        Xout = torch.empty((num_s,) + volume[0].shape[:2], dtype=torch.float32, pin_memory=device.type == 'cuda')
+        stages_used = 0
+        warm = None
+        check = {'time': 0, 'time_full': 0, 'psnr': [], 'ssim': []}
+        start_time = time.time()
+        for start, (Xma, XLI, M, Sma, SLI, Tr) in volume_batches(volume, opt.batch_size, device):
+            with torch.no_grad(), autocast(device.type, opt.amp):
+                if warm is not None:
+                    warm = warm if opt.warm_prior else warm._replace(Y=None)
+                    ListX, ListS, ListYS, used, state = net(Xma, XLI, M, Sma, SLI, Tr, max_stages=opt.warm_start, tol=opt.exit_tol, warm=warm)
+                elif adaptive:
+                    max_stages = opt.S if opt.warm_start and opt.max_stages is None else opt.max_stages
+                    ListX, ListS, ListYS, used, state = net(Xma, XLI, M, Sma, SLI, Tr, max_stages=max_stages, tol=opt.exit_tol)
+                else:
+                    ListX, ListS, ListYS= net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,), roi=roi)
+            if adaptive:
+                stages_used += used.sum()
+            if opt.warm_start:
+                warm = state   # the next slice starts from this one
+            if opt.warm_start and opt.warm_check:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                tic = time.time()
+                with torch.no_grad(), autocast(device.type, opt.amp):
+                    Xfull = net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,))[0][-1]
+                if device.type == 'cuda':
                     torch.cuda.synchronize()
-                start_time = time.time()
-                ListX, ListS, ListYS= net(Xma, XLI, M, Sma, SLI, Tr)
-            Xout= ListX[-1] / 255.0
-            pre_Xout[..., slice_idx] = Xout.data.cpu().numpy().squeeze()
-        nibabel.save(nibabel.Nifti1Image(pre_Xout, allaffine[vol_idx]), Pred_nii + pre_name)
+                check['time_full'] += time.time() - tic
+                Xwarm, Xfull = [torch.clamp(x.float() / 255.0, 0, 0.5) / 0.5 for x in (ListX[-1], Xfull)]
+                check['psnr'] += psnr(Xwarm, Xfull, M).tolist()
+                check['ssim'] += ssim(Xwarm, Xfull, M).tolist()
+                check['time'] += time.time() - tic   # excluded from the throughput of the run itself
+            Xout[start:start + Xma.shape[0]].copy_(ListX[-1][:, 0] / 255.0, non_blocking=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('{:d} slices, {:.2f} slices/s'.format(num_s, num_s / (time.time() - start_time - check['time'])))
+        if adaptive:
+            print('{:.2f} of {:d} stages on average'.format(float(stages_used) / num_s, opt.S))
+        if opt.warm_start and opt.warm_check:
+            print('all stages from scratch: {:.2f} slices/s; warm start against it: PSNR={:.3f} SSIM={:.4f}'.format(
+                num_s / check['time_full'], np.mean(check['psnr']), np.mean(check['ssim'])))
+        pre_Xout = Xout.numpy().transpose(1, 2, 0)
+        nibabel.save(nibabel.Nifti1Image(pre_Xout, affine), Pred_nii + pre_name)
 if __name__ == "__main__":
     main()
 
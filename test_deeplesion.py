@@ -8,14 +8,20 @@ import matplotlib.pyplot as plt
 import h5py
 import PIL
 from PIL import Image
-from network.indudonet import InDuDoNet
-from deeplesion.build_gemotry import initialization, build_gemotry
+from network.indudonet import InDuDoNet, autocast
+from network.fuse import fold_batchnorm
+from network.roi import TileROI
+from deeplesion.build_gemotry import initialization
+from deeplesion.preprocess import prepare
+from deeplesion.metrics import psnr, ssim
+from network.build_gemotry import get_operators, select_astra_gpu
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 parser = argparse.ArgumentParser(description="YU_Test")
 parser.add_argument("--model_dir", type=str, default="models", help='path to model and log files')
 parser.add_argument("--data_path", type=str, default="deeplesion/test/", help='path to training data')
-parser.add_argument("--use_GPU", type=bool, default=True, help='use GPU or not')
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model and the tensors, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--num_threads', type=int, default=0, help='intra-op CPU threads (0: PyTorch default)')
+parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op CPU threads (0: PyTorch default)')
 parser.add_argument("--save_path", type=str, default="./test_results/", help='path to training data')
 parser.add_argument('--num_channel', type=int, default=32, help='the number of dual channels')
 parser.add_argument('--T', type=int, default=4, help='the number of ResBlocks in every ProxNet')
@@ -23,7 +29,30 @@ parser.add_argument('--S', type=int, default=10, help='the number of total itera
 parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
 parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
 parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+parser.add_argument('--precomputed_sgt', action='store_true', help='read Sgt.h5 from deeplesion/precompute_sgt.py instead of projecting Xgt')
+parser.add_argument('--fold_bn', action='store_true', help='fold the BatchNorm layers into the convolutions (inference only)')
+parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='mixed precision inference of the ProxNets and the PriorNet')
+parser.add_argument('--amp_check', action='store_true', help='also run in fp32 and fail if PSNR/SSIM of --amp differ by more than the tolerances')
+parser.add_argument('--psnr_tol', type=float, default=0.1, help='PSNR tolerance (dB) of --amp_check')
+parser.add_argument('--ssim_tol', type=float, default=0.002, help='SSIM tolerance of --amp_check')
+parser.add_argument('--max_stages', type=int, default=None, help='early exit: run at most this many stages')
+parser.add_argument('--exit_tol', type=float, default=None, help='early exit: stop a slice when the relative change of X between stages is below this')
+parser.add_argument('--exit_check', action='store_true', help='also run all S stages and report the latency saved and the PSNR/SSIM of the early exit')
+parser.add_argument('--roi_full_stages', type=int, default=None, help='metal-ROI refinement: full-image CTnet only in the first stages, then on the tiles around the metal (see network/roi.py)')
+parser.add_argument('--roi_tile', type=int, default=52, help='tile size of the metal-ROI refinement')
+parser.add_argument('--roi_margin', type=int, default=16, help='dilation of the metal mask (pixels) of the metal-ROI refinement')
+parser.add_argument('--coarse_stages', type=int, default=0, help='coarse-to-fine: initialization and the first stages on the geometry downsampled by --coarse_factor (must match training)')
+parser.add_argument('--coarse_factor', type=int, default=2, help='downsampling of the coarse geometry (e.g. 2: 208x208 images, 320 views)')
+parser.add_argument('--projector', type=str, default='odl', choices=['odl', 'torch'], help='fan-beam projector backend: odl (astra_cuda, astra_cpu with --device cpu) or torch (native sparse)')
 opt = parser.parse_args()
+if opt.roi_full_stages is not None and (opt.max_stages is not None or opt.exit_tol is not None):
+    parser.error('--roi_full_stages cannot be combined with --max_stages or --exit_tol')
+if opt.coarse_stages > 0 and (opt.max_stages is not None or opt.exit_tol is not None):
+    parser.error('--coarse_stages cannot be combined with --max_stages or --exit_tol')
+if opt.num_threads > 0:
+    torch.set_num_threads(opt.num_threads)
+if opt.num_interop_threads > 0:
+    torch.set_num_interop_threads(opt.num_interop_threads)
 
 def mkdir(path):
     folder = os.path.exists(path)
@@ -44,23 +73,10 @@ mkdir(gt_dir)
 mkdir(outX_dir)
 mkdir(outYS_dir)
 
-def image_get_minmax():
-    return 0.0, 1.0
-
-def proj_get_minmax():
-    return 0.0, 4.0
-
-def normalize(data, minmax):
-    data_min, data_max = minmax
-    data = np.clip(data, data_min, data_max)
-    data = (data - data_min) / (data_max - data_min)
-    data = data * 255.0
-    data = data.astype(np.float32)
-    data = np.expand_dims(np.transpose(np.expand_dims(data, 2), (2, 0, 1)),0)
-    return data
-
 param = initialization()
-ray_trafo = build_gemotry(param)
+device = torch.device(opt.device)
+select_astra_gpu(device)
+impl = 'astra_cuda' if device.type == 'cuda' else 'astra_cpu'
 test_mask = np.load(os.path.join(opt.data_path, 'testmask.npy'))
 def test_image(data_path, imag_idx, mask_idx):
     txtdir = os.path.join(data_path, 'test_640geo_dir.txt')
@@ -79,22 +95,23 @@ def test_image(data_path, imag_idx, mask_idx):
     XLI = file['LI_CT'][()]
     SLI = file['LI_sinogram'][()]
     Tr = file['metal_trace'][()]
-    Sgt = np.asarray(ray_trafo(Xgt))
     file.close()
+    if opt.precomputed_sgt:
+        sgt_file = h5py.File(os.path.join(os.path.dirname(gt_absdir), 'Sgt.h5'), 'r')
+        Sgt = torch.Tensor(sgt_file['Sgt'][()]).to(device)    # already normalized
+        sgt_file.close()
+    else:
+        Sgt = np.asarray(get_operators(param.param, opt.projector, impl).ray_trafo(Xgt))
     M512 = test_mask[:,:,mask_idx]
     M = np.array(Image.fromarray(M512).resize((416, 416), PIL.Image.BILINEAR))
-    Xma = normalize(Xma, image_get_minmax())  # *255
-    Xgt = normalize(Xgt, image_get_minmax())
-    XLI = normalize(XLI, image_get_minmax())
-    Sma = normalize(Sma, proj_get_minmax())
-    Sgt = normalize(Sgt, proj_get_minmax())
-    SLI = normalize(SLI, proj_get_minmax())
-    Tr = 1 - Tr.astype(np.float32)
-    Tr = np.expand_dims(np.transpose(np.expand_dims(Tr, 2), (2, 0, 1)), 0)  # 1*1*h*w
-    Mask = M.astype(np.float32)
-    Mask = np.expand_dims(np.transpose(np.expand_dims(Mask, 2), (2, 0, 1)),0)
-    return torch.Tensor(Xma).cuda(), torch.Tensor(XLI).cuda(), torch.Tensor(Xgt).cuda(), torch.Tensor(Mask).cuda(), \
-       torch.Tensor(Sma).cuda(), torch.Tensor(SLI).cuda(), torch.Tensor(Sgt).cuda(), torch.Tensor(Tr).cuda()
+    if opt.precomputed_sgt:
+        Xma, XLI, Xgt, Sma, SLI, Tr, Mask = prepare((Xma, XLI, Xgt), (Sma, SLI), (Tr,), (M,), device=device)
+        Sgt = Sgt.unsqueeze(0)
+    else:
+        Xma, XLI, Xgt, Sma, SLI, Sgt, Tr, Mask = prepare((Xma, XLI, Xgt), (Sma, SLI, Sgt), (Tr,), (M,), device=device)
+    # 1*1*h*w
+    return Xma.unsqueeze(0), XLI.unsqueeze(0), Xgt.unsqueeze(0), Mask.unsqueeze(0), \
+       Sma.unsqueeze(0), SLI.unsqueeze(0), Sgt.unsqueeze(0), Tr.unsqueeze(0)
 
 
 def print_network(name, net):
@@ -105,21 +122,32 @@ def print_network(name, net):
 
 def main():
     print('Loading model ...\n')
-    net = InDuDoNet(opt).cuda()
+    net = InDuDoNet(opt).to(device)
     print_network("InDuDoNet", net)
-    net.load_state_dict(torch.load(opt.model_dir))
+    net.load_state_dict(torch.load(opt.model_dir, map_location=device))
     net.eval()
+    if opt.fold_bn:
+        fold_batchnorm(net)
     time_test = 0
     count = 0
+    metrics = {'psnr': [], 'ssim': [], 'psnr_fp32': [], 'ssim_fp32': [], 'stages': [], 'psnr_full': [], 'ssim_full': [], 'time_full': []}
+    early_exit = opt.max_stages is not None or opt.exit_tol is not None
+    roi = TileROI(opt.roi_full_stages, opt.roi_tile, opt.roi_margin) if opt.roi_full_stages is not None else None
     for imag_idx in range(1): # for demo
         print(imag_idx)
         for mask_idx in range(10):
             Xma, XLI, Xgt, M, Sma, SLI, Sgt, Tr = test_image(opt.data_path, imag_idx, mask_idx)
             with torch.no_grad():
-                if opt.use_GPU:
+                if device.type == 'cuda':
                     torch.cuda.synchronize()
                 start_time = time.time()
-                ListX, ListS, ListYS= net(Xma, XLI, M, Sma, SLI, Tr)
+                with autocast(device.type, opt.amp):
+                    if early_exit:
+                        ListX, ListS, ListYS, stages_used, _ = net(Xma, XLI, M, Sma, SLI, Tr, max_stages=opt.max_stages, tol=opt.exit_tol)
+                    else:
+                        ListX, ListS, ListYS= net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,), roi=roi)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
             end_time = time.time()
             dur_time = end_time - start_time
             time_test += dur_time
@@ -131,6 +159,33 @@ def main():
             Xmanorm = Xmaclip / 0.5
             Xgtnorm = Xgtclip / 0.5
             YS = torch.clamp(ListYS[-1]/255, 0, 1)
+            metrics['psnr'].append(psnr(Xoutnorm, Xgtnorm, M).item())
+            metrics['ssim'].append(ssim(Xoutnorm, Xgtnorm, M).item())
+            if early_exit:
+                metrics['stages'].append(stages_used.float().mean().item())
+            if early_exit and opt.exit_check:
+                with torch.no_grad():
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    tic = time.time()
+                    with autocast(device.type, opt.amp):
+                        Xfull = net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,))[0][-1]
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                metrics['time_full'].append(time.time() - tic)
+                Xfullnorm = torch.clamp(Xfull / 255.0, 0, 0.5) / 0.5
+                metrics['psnr_full'].append(psnr(Xfullnorm, Xgtnorm, M).item())
+                metrics['ssim_full'].append(ssim(Xfullnorm, Xgtnorm, M).item())
+            if opt.amp_check:
+                # fp32 reference with the same early exit and ROI settings as the run above
+                with torch.no_grad():
+                    if early_exit:
+                        Xref = net(Xma, XLI, M, Sma, SLI, Tr, max_stages=opt.max_stages, tol=opt.exit_tol)[0][-1]
+                    else:
+                        Xref = net(Xma, XLI, M, Sma, SLI, Tr, stages=(-1,), roi=roi)[0][-1]
+                Xrefnorm = torch.clamp(Xref / 255.0, 0, 0.5) / 0.5
+                metrics['psnr_fp32'].append(psnr(Xrefnorm, Xgtnorm, M).item())
+                metrics['ssim_fp32'].append(ssim(Xrefnorm, Xgtnorm, M).item())
             idx = imag_idx *10+ mask_idx  + 1
             plt.imsave(input_dir + str(idx) + '.png', Xmanorm.data.cpu().numpy().squeeze(), cmap="gray")
             plt.imsave(gt_dir + str(idx) + '.png', Xgtnorm.data.cpu().numpy().squeeze(), cmap="gray")
@@ -138,6 +193,21 @@ def main():
             plt.imsave(outYS_dir + str(idx) + '.png', YS.data.cpu().numpy().squeeze(), cmap="gray")
             count += 1
     print('Avg.time={:.4f}'.format(time_test/count))
+    print('PSNR={:.3f} SSIM={:.4f} (non-metal region)'.format(np.mean(metrics['psnr']), np.mean(metrics['ssim'])))
+    if early_exit:
+        print('early exit: {:.2f} of {:d} stages on average'.format(np.mean(metrics['stages']), opt.S))
+    if early_exit and opt.exit_check:
+        time_full = np.mean(metrics['time_full'])
+        print('all stages: Avg.time={:.4f} PSNR={:.3f} SSIM={:.4f}; early exit saves {:.1f}% latency, dPSNR={:+.3f} dSSIM={:+.4f}'.format(
+            time_full, np.mean(metrics['psnr_full']), np.mean(metrics['ssim_full']), 100 * (1 - time_test / count / time_full),
+            np.mean(metrics['psnr']) - np.mean(metrics['psnr_full']), np.mean(metrics['ssim']) - np.mean(metrics['ssim_full'])))
+    if opt.amp_check:
+        dpsnr = np.mean(metrics['psnr']) - np.mean(metrics['psnr_fp32'])
+        dssim = np.mean(metrics['ssim']) - np.mean(metrics['ssim_fp32'])
+        print('fp32: PSNR={:.3f} SSIM={:.4f}; {}: dPSNR={:+.3f} dSSIM={:+.4f}'.format(
+            np.mean(metrics['psnr_fp32']), np.mean(metrics['ssim_fp32']), opt.amp, dpsnr, dssim))
+        if abs(dpsnr) > opt.psnr_tol or abs(dssim) > opt.ssim_tol:
+            raise SystemExit('{} exceeds the tolerance (PSNR {:.3f} dB, SSIM {:.4f})'.format(opt.amp, opt.psnr_tol, opt.ssim_tol))
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+import torch.utils.data as udata
+from deeplesion import MARTrainDataset
+
+
+class TestMARTrainDataset(unittest.TestCase):
+    def setUp(self):
+        # two slices with different precomputed Sgt, one metal variant each
+        self.dir = tempfile.mkdtemp()
+        lines = []
+        for n, value in enumerate((1.0, 2.0)):
+            folder = os.path.join(self.dir, 'train_640geo', 'slice{:d}'.format(n))
+            os.makedirs(folder)
+            with h5py.File(os.path.join(folder, 'gt.h5'), 'w') as f:
+                f.create_dataset('image', data=np.zeros((416, 416), np.float32))
+            with h5py.File(os.path.join(folder, 'Sgt.h5'), 'w') as f:
+                f.create_dataset('Sgt', data=np.full((640, 641), value, np.float32))
+            for mask in range(10):
+                with h5py.File(os.path.join(folder, '{:d}.h5'.format(mask)), 'w') as f:
+                    for key in ('ma_CT', 'LI_CT'):
+                        f.create_dataset(key, data=np.zeros((416, 416), np.float32))
+                    for key in ('ma_sinogram', 'LI_sinogram', 'metal_trace'):
+                        f.create_dataset(key, data=np.zeros((640, 641), np.float32))
+            lines.append('slice{:d}/gt.h5\n'.format(n))
+        with open(os.path.join(self.dir, 'train_640geo_dir.txt'), 'w') as f:
+            f.writelines(lines)
+        self.mask = np.zeros((512, 512, 10), np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_precomputed_sgt_not_shared(self):
+        for max_open_files in (0, 4):
+            dataset = MARTrainDataset(self.dir, 416, self.mask, precomputed_sgt=True, max_open_files=max_open_files)
+            Sgt = next(iter(udata.DataLoader(dataset, batch_size=2)))[6]
+            self.assertEqual(Sgt[:, 0].flatten(1).mean(1).tolist(), [1.0, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,16 +14,18 @@ import torch.nn.functional as  F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import time
 import matplotlib.pyplot as plt
 import numpy as np
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader
-from math import ceil
-from deeplesion.Dataset import MARTrainDataset
-from network.indudonet import InDuDoNet
+from torch.utils.data.distributed import DistributedSampler
+from deeplesion.Dataset import MARTrainDataset, MARShardDataset, worker_init_fn
+from network.indudonet import InDuDoNet, autocast
+from network.build_gemotry import select_astra_gpu
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 parser = argparse.ArgumentParser()
 parser.add_argument("--data_path", type=str, default="./deep_lesion/", help='txt path to training spa-data')
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=0)
@@ -41,8 +43,25 @@ parser.add_argument('--model_dir', default='./models/', help='saving model')
 parser.add_argument('--eta1', type=float, default=1, help='initialization for stepsize eta1')
 parser.add_argument('--eta2', type=float, default=5, help='initialization for stepsize eta2')
 parser.add_argument('--alpha', type=float, default=0.5, help='initialization for weight factor')
+parser.add_argument('--max_open_files', type=int, default=0, help='keep up to this many h5 files open per data loading worker (0: open per sample)')
+parser.add_argument('--shard_path', type=str, default='', help='read the shards of deeplesion/pack_shards.py instead of the h5 files')
+parser.add_argument('--precomputed_sgt', action='store_true', help='read Sgt.h5 from deeplesion/precompute_sgt.py instead of projecting Xgt')
+parser.add_argument('--coarse_stages', type=int, default=0, help='coarse-to-fine: initialization and the first stages on the geometry downsampled by --coarse_factor (must match training)')
+parser.add_argument('--coarse_factor', type=int, default=2, help='downsampling of the coarse geometry (e.g. 2: 208x208 images, 320 views)')
+parser.add_argument('--projector', type=str, default='odl', choices=['odl', 'torch'], help='fan-beam projector backend: odl (astra_cuda, astra_cpu with --device cpu) or torch (native sparse)')
+parser.add_argument('--checkpoint_stages', type=int, default=0, help='stages per activation-checkpointed segment, recomputed in backward (0: off)')
+parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='mixed precision of the ProxNets and the PriorNet (projections and gradient steps stay in fp32), fp16 with grad scaling')
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the model and the tensors, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--num_threads', type=int, default=0, help='intra-op CPU threads (0: PyTorch default)')
+parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op CPU threads (0: PyTorch default)')
+parser.add_argument('--dist_backend', type=str, default=None, choices=['nccl', 'gloo'], help='DDP backend when launched with torchrun (default: nccl on cuda, gloo on cpu)')
+parser.add_argument('--sync_bn', action='store_true', help='synchronize the BatchNorm statistics across the DDP processes (nccl)')
 parser.add_argument('--gamma', type=float, default=1e-1, help='hyper-parameter for balancing different loss items')
 opt = parser.parse_args()
+if opt.num_threads > 0:
+    torch.set_num_threads(opt.num_threads)
+if opt.num_interop_threads > 0:
+    torch.set_num_interop_threads(opt.num_interop_threads)
 
 # create path
 
@@ -57,12 +76,31 @@ except OSError:
 cudnn.benchmark = True
 
 
-def train_model(net,optimizer, scheduler,datasets):
-    data_loader = DataLoader(datasets, batch_size=opt.batchSize, shuffle=True, num_workers=int(opt.workers),
-                             pin_memory=True)
-    num_data = len(datasets)
-    num_iter_epoch = ceil(num_data / opt.batchSize)
-    writer = SummaryWriter(opt.log_dir)
+def setup_distributed():
+    # (rank, world_size, device); under torchrun every process trains on its shard of the data with DDP,
+    # on its own GPU (--device cuda) or on the CPU (--device cpu). --batchSize is per process
+    device = torch.device(opt.device)
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        select_astra_gpu(device)
+        return 0, 1, device
+    dist.init_process_group(opt.dist_backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+        select_astra_gpu(device)   # the odl projections of this rank and of its DataLoader workers
+    return dist.get_rank(), world_size, device
+
+
+def train_model(net,optimizer, scheduler,datasets, rank=0, world_size=1, device=torch.device('cuda')):
+    # only rank 0 logs and writes the checkpoints
+    sampler = DistributedSampler(datasets, num_replicas=world_size, rank=rank, shuffle=True) if world_size > 1 else None
+    data_loader = DataLoader(datasets, batch_size=opt.batchSize, shuffle=sampler is None, sampler=sampler,
+                             num_workers=int(opt.workers), pin_memory=device.type == 'cuda', worker_init_fn=worker_init_fn)
+    num_iter_epoch = len(data_loader)
+    model = net.module if world_size > 1 else net
+    writer = SummaryWriter(opt.log_dir) if rank == 0 else None
+    scaler = torch.amp.GradScaler('cuda', enabled=opt.amp == 'fp16' and device.type == 'cuda')
     step = 0
     for epoch in range(opt.resume, opt.niter):
         mse_per_epoch = 0
@@ -70,11 +108,14 @@ def train_model(net,optimizer, scheduler,datasets):
         # train stage
         lr = optimizer.param_groups[0]['lr']
         phase = 'train'
+        if sampler is not None:
+            sampler.set_epoch(epoch)
         for ii, data in enumerate(data_loader):
-            Xma, XLI, Xgt, mask, Sma, SLI, Sgt, Tr = [x.cuda() for x in data]
+            Xma, XLI, Xgt, mask, Sma, SLI, Sgt, Tr = [x.to(device, non_blocking=True) for x in data]
             net.train()
             optimizer.zero_grad()
-            ListX, ListS, ListYS= net(Xma, XLI, mask, Sma, SLI, Tr)
+            with autocast(device.type, opt.amp):
+                ListX, ListS, ListYS= net(Xma, XLI, mask, Sma, SLI, Tr)
             loss_l2YSmid = 0.1 * F.mse_loss(ListYS[opt.S -2], Sgt)
             loss_l2Xmid = 0.1 * F.mse_loss(ListX[opt.S -2] * (1 - mask), Xgt * (1 - mask))
             loss_l2YSf = F.mse_loss(ListYS[-1], Sgt)
@@ -82,23 +123,32 @@ def train_model(net,optimizer, scheduler,datasets):
             loss_l2YS = loss_l2YSf + loss_l2YSmid
             loss_l2X = loss_l2Xf +  loss_l2Xmid
             loss = opt.gamma * loss_l2YS + loss_l2X
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             mse_iter = loss.item()
             mse_per_epoch += mse_iter
-            if ii % 400 == 0:
+            if ii % 400 == 0 and rank == 0:
                 template = '[Epoch:{:>2d}/{:<2d}] {:0>5d}/{:0>5d}, Loss={:5.2e},  Lossl2YS={:5.2e}, Lossl2X={:5.2e}, lr={:.2e}'
                 print(template.format(epoch + 1, opt.niter, ii, num_iter_epoch, mse_iter, loss_l2YS, loss_l2X, lr))
-            writer.add_scalar('Loss', loss, step)
-            writer.add_scalar('Loss_YS', loss_l2YS, step)
-            writer.add_scalar('Loss_X', loss_l2X, step)
+            if writer is not None:
+                writer.add_scalar('Loss', loss, step)
+                writer.add_scalar('Loss_YS', loss_l2YS, step)
+                writer.add_scalar('Loss_X', loss_l2X, step)
             step += 1
         mse_per_epoch /= (ii + 1)
+        if world_size > 1:
+            # mean over the processes
+            mse_per_epoch = torch.tensor(mse_per_epoch, device=device)
+            dist.all_reduce(mse_per_epoch)
+            mse_per_epoch = mse_per_epoch.item() / world_size
+        scheduler.step()
+        if rank != 0:
+            continue
         print('Loss={:+.2e}'.format(mse_per_epoch))
         print('-' * 100)
-        scheduler.step()
         # save model
-        torch.save(net.state_dict(), os.path.join(opt.model_dir, 'InDuDoNet_latest.pt'))
+        torch.save(model.state_dict(), os.path.join(opt.model_dir, 'InDuDoNet_latest.pt'))
         if epoch % 10 == 0:
             # save model
             model_prefix = 'model_'
@@ -107,11 +157,12 @@ def train_model(net,optimizer, scheduler,datasets):
                 'epoch': epoch + 1,
                 'step': step + 1,
             }, save_path_model)
-            torch.save(net.state_dict(), os.path.join(opt.model_dir, 'InDuDoNet_%d.pt' % (epoch + 1)))
+            torch.save(model.state_dict(), os.path.join(opt.model_dir, 'InDuDoNet_%d.pt' % (epoch + 1)))
         toc = time.time()
         print('This epoch take time {:.2f}'.format(toc - tic))
-    writer.close()
-    print('Reach the maximal epochs! Finish training')
+    if writer is not None:
+        writer.close()
+        print('Reach the maximal epochs! Finish training')
 
 if __name__ == '__main__':
     def print_network(name, net):
@@ -119,20 +170,33 @@ if __name__ == '__main__':
         for param in net.parameters():
             num_params += param.numel()
         print('name={:s}, Total number={:d}'.format(name, num_params))
-    net = InDuDoNet(opt).cuda()
-    print_network("InDuDoNet:", net)
+    rank, world_size, device = setup_distributed()
+    net = InDuDoNet(opt).to(device)
+    if rank == 0:
+        print_network("InDuDoNet:", net)
+    if opt.resume:
+        net.load_state_dict(torch.load(os.path.join(opt.model_dir, 'InDuDoNet_%d.pt' % (opt.resume)), map_location=device))
+        if rank == 0:
+            print('loaded checkpoints, epoch{:d}'.format(opt.resume))
+    if world_size > 1:
+        if opt.sync_bn:
+            net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
+        net = DistributedDataParallel(net, device_ids=[device.index] if device.type == 'cuda' else None)
     optimizer= optim.Adam(net.parameters(), betas=(0.5, 0.999), lr=opt.lr)
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=opt.milestone,gamma=0.5)  # learning rates
     # from opt.resume continue to train
     for _ in range(opt.resume):
         scheduler.step()
-    if opt.resume:
-        net.load_state_dict(torch.load(os.path.join(opt.model_dir, 'InDuDoNet_%d.pt' % (opt.resume))))
-        print('loaded checkpoints, epoch{:d}'.format(opt.resume))
     # load dataset
     train_mask = np.load(os.path.join(opt.data_path, 'trainmask.npy'))
-    train_dataset = MARTrainDataset(opt.data_path, opt.patchSize, train_mask)
+    if opt.shard_path:
+        train_dataset = MARShardDataset(opt.shard_path, opt.patchSize, train_mask)
+    else:
+        train_dataset = MARTrainDataset(opt.data_path, opt.patchSize, train_mask, opt.projector, opt.precomputed_sgt,
+                                        opt.max_open_files, 'astra_cuda' if device.type == 'cuda' else 'astra_cpu')
 
     # train model
-    train_model(net, optimizer, scheduler,train_dataset)
+    train_model(net, optimizer, scheduler,train_dataset, rank, world_size, device)
+    if world_size > 1:
+        dist.destroy_process_group()
 